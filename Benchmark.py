@@ -0,0 +1,450 @@
+"""
+SCI 2000 Group Project - Image Compression (Benchmark)
+
+Run:    python3 Benchmark.py [options]
+
+        -o, --output        write the results as JSON into this file (default: benchmark.json)
+        --corpus            directory of the generated PNG images (default: benchmark-corpus)
+        --max-size          leave out images wider or higher than this (default: 8192)
+        --only              only run the cases whose name contains this text
+        --repeat            run every case this many times, and keep the fastest time of each stage (default: 3)
+        --no-isolate        run every case in this process (peak RSS is then the peak of the whole run)
+        --compare           compare the results with an earlier JSON file; exit code 1 on a regression
+        --threshold         slow-down reported as a regression by --compare (default: 0.10 = 10%)
+        --verify            decode every case with each inflate backend and compare it with the
+                            generated samples instead of timing it; exit code 1 on a mismatch
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import zlib
+
+import numpy as np
+
+import Playground
+
+# =================================================================================
+# Corpus
+#
+# - every case is one PNG image, generated from a fixed seed (CRC-32 of the case
+#   name), so the corpus is the same on every run and every machine; images are
+#   written once into the corpus directory and reused.
+# - cases (name prefix):
+#   - size-*:       RGB 8 bits, adaptive filtering; 1x1 up to 8192x8192.
+#   - colour-*:     every colour type and bit depth; 256x256.
+#   - filter-*:     every filter type forced on all rows, and adaptive; 512x512 RGB.
+#                   The samples are smooth, so adaptive filtering picks Average for
+#                   almost every row; the mixed cases force filters alternating row
+#                   by row, as adaptive encoders produce on photographs.
+#   - adam7-*:      Adam7 on / off for a few colour types; 512x512.
+#   - idat-*:       one IDAT chunk vs. IDAT chunks of 256 bytes; 512x512 RGB.
+# - the samples are smooth waves (different for each channel) with a little noise,
+#   so filters and compression behave roughly as on photographs.
+# =================================================================================
+SIZES = ((1, 1), (3, 7), (64, 64), (512, 512), (2048, 2048), (8192, 8192))   # (width, height)
+COLOUR_CASES = ((0, 1), (0, 2), (0, 4), (0, 8), (0, 16), (2, 8), (2, 16), (3, 1), (3, 2), (3, 4), (3, 8), (4, 8), (4, 16), (6, 8), (6, 16))   # (colourType, bitDepth)
+FILTER_NAMES = {
+    None: 'adaptive', 0: 'none', 1: 'sub', 2: 'up', 3: 'average', 4: 'paeth',
+    (4, 2): 'paeth-up', (3, 1): 'average-sub', (0, 1, 2, 3, 4): 'mixed'     # in turn, row after row
+}
+COLOUR_NAMES = {0: 'grey', 2: 'rgb', 3: 'palette', 4: 'greyalpha', 6: 'rgba'}
+
+SINGLE_IDAT_SIZE = (1 << 31) - 1   # max. chunk length => everything in one IDAT chunk
+MANY_IDAT_SIZE = 256
+IDAT_NAMES = {SINGLE_IDAT_SIZE: 'single'}
+GENERATE_BAND_SIZE = 256           # rows generated at once (keeps the float temporaries small)
+
+def make_case(width, height, colourType=2, bitDepth=8, filterType=None, interlace=False, idatSize=Playground.IDAT_CHUNK_SIZE, prefix="size"):
+    name = "{0}-{1}x{2}-{3}{4}-{5}{6}".format(
+        prefix, width, height, COLOUR_NAMES[colourType], bitDepth, FILTER_NAMES[filterType], ("-adam7") if (interlace) else ("")
+    )
+    name += ("-idat{0}".format(IDAT_NAMES.get(idatSize, idatSize))) if (idatSize != Playground.IDAT_CHUNK_SIZE) else ("")
+    return {
+        'name': name,
+        'width': width,
+        'height': height,
+        'colourType': colourType,
+        'bitDepth': bitDepth,
+        'filterType': filterType,
+        'interlace': interlace,
+        'idatSize': idatSize
+    }
+
+# all cases with width and height <= maxSize, in order
+def build_corpus(maxSize=8192):
+    cases = [make_case(width, height) for (width, height) in SIZES]
+    cases += [make_case(256, 256, colourType, bitDepth, prefix="colour") for (colourType, bitDepth) in COLOUR_CASES]
+    cases += [make_case(512, 512, filterType=filterType, prefix="filter") for filterType in FILTER_NAMES]
+    cases += [
+        make_case(512, 512, colourType, bitDepth, interlace=interlace, prefix="adam7")
+        for (colourType, bitDepth) in ((2, 8), (0, 1), (6, 16)) for interlace in (False, True)
+    ]
+    cases += [make_case(512, 512, idatSize=idatSize, prefix="idat") for idatSize in (SINGLE_IDAT_SIZE, MANY_IDAT_SIZE)]
+    return [case for case in cases if case['width'] <= maxSize and case['height'] <= maxSize]
+
+# deterministic samples of a case, shape (height, width, samples per pixel); returns (samples, palette or None)
+def make_samples(case):
+    (width, height, colourType, bitDepth) = (case['width'], case['height'], case['colourType'], case['bitDepth'])
+    rng = np.random.default_rng(zlib.crc32(case['name'].encode('ascii')))
+    samplesPerPixel = Playground.SAMPLES_PER_PIXEL[colourType]
+
+    palette = None
+    maxSampleVal = (1 << bitDepth) - 1
+    if colourType == 3:
+        palette = rng.integers(0, 256, (min(256, 1 << bitDepth), 3), dtype=np.uint8)
+        maxSampleVal = len(palette) - 1
+
+    frequencies = rng.uniform(1.0, 6.0, samplesPerPixel).astype(np.float32)
+    phases = rng.uniform(0.0, 2 * np.pi, samplesPerPixel).astype(np.float32)
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)
+
+    samples = np.empty((height, width, samplesPerPixel), dtype=(np.uint16) if (bitDepth == 16) else (np.uint8))
+    for startIdx in range(0, height, GENERATE_BAND_SIZE):
+        bandY = y[startIdx : startIdx+GENERATE_BAND_SIZE, None]
+        for channel in range(0, samplesPerPixel):
+            wave = 0.5 + 0.4 * np.sin(2 * np.pi * frequencies[channel] * (x + 0.6 * bandY) + phases[channel])
+            wave += rng.normal(0.0, 0.02, wave.shape).astype(np.float32)
+            samples[startIdx : startIdx+GENERATE_BAND_SIZE, :, channel] = np.rint(np.clip(wave, 0.0, 1.0) * maxSampleVal)
+    return (samples, palette)
+
+# file of the case in the corpus directory; generated if missing
+def get_case_file(case, corpusDir):
+    fileName = os.path.join(corpusDir, case['name'] + ".png")
+    if not os.path.exists(fileName):
+        (samples, palette) = make_samples(case)
+        pngDatastream = Playground.encode_png(
+            samples, case['bitDepth'], palette, case['interlace'], case['filterType'], idatSize=case['idatSize']
+        )
+        tempFileName = "{0}.{1}.tmp".format(fileName, os.getpid())
+        with open(tempFileName, 'wb') as out:
+            Playground.write_png_datastream(out, pngDatastream)
+        os.replace(tempFileName, fileName)
+    return fileName
+
+# =================================================================================
+# Stages
+#
+# - the stages of the converter are run one after another on the whole image, so
+#   each one can be timed on its own:
+#   parse       = read_png_datastream() on the file in memory (CRC-32 checked)
+#   inflate     = iter_inflate() over all IDAT data (ADLER-32 checked)
+#   unfilter    = iter_filtered_scanlines() -> iter_unfiltered_scanlines() over the
+#                 inflated pieces, in bands as the converter does (pass by pass
+#                 if interlaced, as iter_adam7_passes())
+#   deserialize = deserialize_scanlines() (and deinterlace_adam7())
+#   write       = write_ppm() of the output samples (palette looked up, alpha dropped)
+# - bytes of each stage: parse = file size, write = PPM size, otherwise the
+#   inflated image data.
+# - peak RSS of the process (see get_peak_rss()); with isolation every case runs in
+#   a new process, so it is the peak of that case (plus the interpreter and NumPy).
+# - bytes read from the file by probe() (--info), which must seek over the IDAT data.
+# =================================================================================
+STAGES = ('parse', 'inflate', 'unfilter', 'deserialize', 'write')
+
+# runs the stages once; returns ({stage: seconds}, {stage: bytes})
+def run_stages(data):
+    seconds = {}
+    startTime = time.perf_counter()
+    pngDatastream = Playground.read_png_datastream(data)
+    seconds['parse'] = time.perf_counter() - startTime
+
+    ihdrData = pngDatastream.get_idhr_chunk().get_data()
+    (width, height, colourType, bitDepth) = (ihdrData.width, ihdrData.height, ihdrData.colourType, ihdrData.bitDepth)
+    bitsPerPixel = Playground.get_bits_per_pixel(colourType, bitDepth)
+    filterUnit = Playground.get_filter_unit(bitsPerPixel)
+    idatData = [chunk.get_data() for chunk in pngDatastream.get_idat_chunk()]
+
+    startTime = time.perf_counter()
+    inflatedPieces = list(Playground.iter_inflate(idatData))
+    seconds['inflate'] = time.perf_counter() - startTime
+    inflatedBytes = sum([len(piece) for piece in inflatedPieces])
+
+    # (passIdx, passWidth, passHeight) of every image stored
+    if ihdrData.interlaceMethod == 0:
+        images = [(None, width, height)]
+    else:
+        images = [
+            (passIdx, passWidth, passHeight)
+            for (passIdx, (passWidth, passHeight)) in enumerate(Playground.get_adam7_pass_sizes(width, height))
+            if passWidth > 0 and passHeight > 0
+        ]
+
+    startTime = time.perf_counter()
+    if ihdrData.interlaceMethod == 0:
+        lineLengths = itertools.repeat(Playground.get_scanline_length(width, bitsPerPixel), height)
+    else:
+        lineLengths = Playground.get_adam7_scanline_lengths(width, height, bitsPerPixel)
+    filteredScanlines = Playground.iter_filtered_scanlines(inflatedPieces, lineLengths)
+    unfiltered = []
+    for (passIdx, passWidth, passHeight) in images:
+        scanlines = np.empty((passHeight, Playground.get_scanline_length(passWidth, bitsPerPixel) - 1), dtype=np.uint8)
+        for (rowIdx, scanline) in enumerate(Playground.iter_unfiltered_scanlines(itertools.islice(filteredScanlines, passHeight), filterUnit)):
+            scanlines[rowIdx] = scanline
+        unfiltered.append(scanlines)
+    seconds['unfilter'] = time.perf_counter() - startTime
+    del inflatedPieces
+
+    startTime = time.perf_counter()
+    if ihdrData.interlaceMethod == 0:
+        samples = Playground.deserialize_scanlines(unfiltered[0], width, colourType, bitDepth)
+    else:
+        passes = [
+            (passIdx, Playground.deserialize_scanlines(scanlines, passWidth, colourType, bitDepth))
+            for ((passIdx, passWidth, passHeight), scanlines) in zip(images, unfiltered)
+        ]
+        samples = Playground.deinterlace_adam7(passes, width, height, colourType, bitDepth)
+    seconds['deserialize'] = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    palette = None
+    if colourType == 3:
+        palette = Playground.build_palette(pngDatastream.get_plte_chunk(), pngDatastream.get_trns_chunk())
+    pixels = Playground.get_output_samples(samples, colourType, palette)
+    imgType = Playground.get_ppm_type(Playground.get_output_channels(colourType))
+    maxPixelVal = Playground.get_max_pixel_value(colourType, bitDepth)
+    with open(os.devnull, 'wb') as out:
+        Playground.write_ppm(out, imgType, width, height, maxPixelVal, pixels)
+    seconds['write'] = time.perf_counter() - startTime
+
+    header = Playground.format_ppm_header(imgType, width, height, maxPixelVal)
+    outputBytes = len(header) + pixels.size * ((2) if (maxPixelVal > 255) else (1))
+    byteCounts = {'parse': len(data), 'inflate': inflatedBytes, 'unfilter': inflatedBytes, 'deserialize': inflatedBytes, 'write': outputBytes}
+    return (seconds, byteCounts)
+
+# - peak resident set size of this process in bytes, or None where unknown.
+# - Linux: VmHWM of /proc/self/status, which starts over in a new process
+#   (ru_maxrss is inherited from the parent across fork and exec).
+def get_peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024      # kB
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:     # e.g. Windows
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (maxRss) if (sys.platform == 'darwin') else (maxRss * 1024)     # bytes on macOS, KiB elsewhere
+
+# - runs the stages repeat times; returns the result of the case (JSON-ready).
+# - the fastest time of each stage is kept.
+def run_case(case, fileName, repeat):
+    with open(fileName, "rb") as f:
+        data = f.read()
+
+    bestSeconds = {stage: None for stage in STAGES}
+    for i in range(0, repeat):
+        (seconds, byteCounts) = run_stages(data)
+        for stage in STAGES:
+            bestSeconds[stage] = (seconds[stage]) if (bestSeconds[stage] is None) else (min(bestSeconds[stage], seconds[stage]))
+
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = {
+            'seconds': bestSeconds[stage],
+            'bytes': byteCounts[stage],
+            'mbPerSec': (byteCounts[stage] / bestSeconds[stage] / 1e6) if (bestSeconds[stage] > 0) else (None)
+        }
+
+    with Playground.instrumented(Playground.Instrumentation()) as instrumentation:
+        Playground.probe(fileName)
+
+    result = dict(case)
+    result.update({
+        'fileBytes': len(data),
+        'fileCrc32': "{0:08X}".format(zlib.crc32(data)),
+        'idatBytes': sum([chunk.get_length() for chunk in Playground.read_png_datastream(data).get_idat_chunk()]),
+        'probeBytesRead': instrumentation.get_counters().get('fileBytesRead', 0),
+        'totalSeconds': sum(bestSeconds.values()),
+        'stages': stages,
+        'peakRssBytes': get_peak_rss()
+    })
+    return result
+
+# - isolate = run the case in a new process (spawned, so nothing is inherited), which
+#   makes its peak RSS its own.
+def run_case_isolated(case, fileName, repeat, isolate=True):
+    if not isolate:
+        return run_case(case, fileName, repeat)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_case, case, fileName, repeat).result()
+
+# =================================================================================
+# Results
+#
+# - JSON: {'environment': {...}, 'settings': {...}, 'cases': [result of run_case(), ...]}
+# - compare: stage times and peak RSS of every case that is in both files and was
+#   run on the same image (same CRC-32); a ratio above 1 + threshold is a regression,
+#   unless the stage got slower by less than COMPARE_MIN_SECONDS (timer noise).
+# =================================================================================
+COMPARE_MIN_SECONDS = 0.001
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'zlib': zlib.ZLIB_RUNTIME_VERSION,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpuCount': os.cpu_count()
+    }
+
+def format_result(result):
+    stages = " ".join([
+        "{0} {1:8.2f}".format(stage, result['stages'][stage]['mbPerSec'] or 0.0) for stage in STAGES
+    ])
+    peakRss = (result['peakRssBytes'] / (1 << 20)) if (result['peakRssBytes'] is not None) else (0.0)
+    return "{0:52} {1:9.4f} s  MB/s: {2}  peak RSS {3:7.1f} MB".format(result['name'], result['totalSeconds'], stages, peakRss)
+
+# probe() must not read the IDAT data; returns an error line, or None
+def check_probe(result):
+    if result['probeBytesRead'] > result['fileBytes'] - result['idatBytes']:
+        return "[-] {0}: probe read {1} of {2} bytes ({3} bytes of IDAT data)".format(
+            result['name'], result['probeBytesRead'], result['fileBytes'], result['idatBytes']
+        )
+    return None
+
+# returns the lines of the comparison and the number of regressions
+def compare_results(baseline, results, threshold):
+    baselineCases = {result['name']: result for result in baseline['cases']}
+    lines = []
+    regressions = 0
+
+    for result in results['cases']:
+        old = baselineCases.get(result['name'])
+        if old is None:
+            lines.append("{0:52} (not in baseline)".format(result['name']))
+            continue
+        if old['fileCrc32'] != result['fileCrc32']:
+            lines.append("{0:52} (different image, not compared)".format(result['name']))
+            continue
+
+        changes = []
+        for stage in STAGES + ('total',):
+            oldSeconds = (old['totalSeconds']) if (stage == 'total') else (old['stages'][stage]['seconds'])
+            newSeconds = (result['totalSeconds']) if (stage == 'total') else (result['stages'][stage]['seconds'])
+            if oldSeconds > 0:
+                ratio = newSeconds / oldSeconds
+                isRegression = ratio > 1 + threshold and newSeconds - oldSeconds > COMPARE_MIN_SECONDS
+                regressions += (1) if (isRegression) else (0)
+                changes.append("{0} {1:+6.1f}%{2}".format(stage, (ratio - 1) * 100, ("!") if (isRegression) else (" ")))
+        if old['peakRssBytes'] and result['peakRssBytes']:
+            changes.append("RSS {0:+6.1f}%".format((result['peakRssBytes'] / old['peakRssBytes'] - 1) * 100))
+        lines.append("{0:52} {1}".format(result['name'], "  ".join(changes)))
+
+    return (lines, regressions)
+
+# =================================================================================
+# Verify
+#
+# - --verify decodes every case with each inflate backend (INFLATE_BACKENDS) and
+#   compares the samples with the ones the image was generated from; nothing is
+#   timed. This covers the un-filter paths (vector, wavefront, bytewise) and the
+#   native inflater on every colour type, filter pattern and size of the corpus.
+# - a band of rows in the middle is also decoded on its own (decode_rows()), so the
+#   scanlines above it are un-filtered only as far as the band depends on them.
+# - the native backend is pure Python and slow on the large cases; --max-size
+#   keeps the run short.
+# =================================================================================
+
+# returns the error messages of a case; empty if it decodes as expected
+def verify_case(case, fileName):
+    (expected, palette) = make_samples(case)
+    (start, stop) = (case['height'] // 3, case['height'] - case['height'] // 3)
+
+    errors = []
+    for inflateBackend in Playground.INFLATE_BACKENDS:
+        try:
+            samples = Playground.PngImage.open(fileName, inflateBackend=inflateBackend).get_samples()
+            if not np.array_equal(samples, expected):
+                errors.append("{0}: samples differ from the generated ones".format(inflateBackend))
+            rows = Playground.PngImage.open(fileName, inflateBackend=inflateBackend).decode_rows(start, stop)
+            if not np.array_equal(rows, expected[start:stop]):
+                errors.append("{0}: rows {1}...{2} differ from the generated ones".format(inflateBackend, start, stop - 1))
+        except Exception as e:
+            errors.append("{0}: {1}: {2}".format(inflateBackend, type(e).__name__, e))
+    return errors
+
+# =================================================================================
+# Main
+# =================================================================================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PNG => PPM stages on a generated corpus.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON results file (default: benchmark.json)")
+    parser.add_argument("--corpus", default="benchmark-corpus", help="directory of the generated images (default: benchmark-corpus)")
+    parser.add_argument("--max-size", type=int, default=8192, help="leave out images wider or higher than this (default: 8192)")
+    parser.add_argument("--only", default=None, help="only run the cases whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case; the fastest time of each stage is kept (default: 3)")
+    parser.add_argument("--no-isolate", dest='isolate', action='store_false', help="run every case in this process")
+    parser.add_argument("--compare", default=None, metavar="JSON", help="compare with earlier results; exit code 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slow-down reported as a regression (default: 0.10)")
+    parser.add_argument("--verify", action='store_true', help="check that every case decodes to its generated samples with each inflate backend (no timing)")
+    args = parser.parse_args(argv)
+
+    cases = build_corpus(args.max_size)
+    if args.only is not None:
+        cases = [case for case in cases if args.only in case['name']]
+    if len(cases) == 0:
+        parser.error("no cases to run")
+    os.makedirs(args.corpus, exist_ok=True)
+
+    if args.verify:
+        failures = 0
+        for case in cases:
+            errors = verify_case(case, get_case_file(case, args.corpus))
+            if len(errors) == 0:
+                print("[+] {0}".format(case['name']))
+            for error in errors:
+                print("[-] {0}: {1}".format(case['name'], error))
+            failures += (1) if (len(errors) > 0) else (0)
+            sys.stdout.flush()
+        print("[*] {0} verified, {1} failed".format(len(cases) - failures, failures))
+        return (1) if (failures > 0) else (0)
+
+    results = {
+        'environment': get_environment(),
+        'settings': {'repeat': args.repeat, 'isolate': args.isolate, 'maxSize': args.max_size},
+        'cases': []
+    }
+    failures = 0
+    for case in cases:
+        fileName = get_case_file(case, args.corpus)
+        result = run_case_isolated(case, fileName, max(1, args.repeat), args.isolate)
+        results['cases'].append(result)
+        print(format_result(result))
+        probeError = check_probe(result)
+        if probeError is not None:
+            print(probeError)
+            failures += 1
+        sys.stdout.flush()
+
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent=1)
+    print("[*] results written to {0}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        (lines, regressions) = compare_results(baseline, results, args.threshold)
+        print("\n[*] compared with {0}".format(args.compare))
+        for line in lines:
+            print(line)
+        print("[*] {0} regression(s) above {1:.0f}%".format(regressions, args.threshold * 100))
+        return (1) if (regressions > 0 or failures > 0) else (0)
+
+    return (1) if (failures > 0) else (0)
+
+if __name__ == "__main__":
+    sys.exit(main())
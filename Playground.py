@@ -4,17 +4,271 @@ SCI 2000 Group Project - Image Compression
 Name:   Justin M. C. Choi & Mike Winkler
 Date:   Dec/03/2019 (Tue) 
 
-Run:    python3 Playground.py <image_path>
+Run:    python3 Playground.py <image_path | directory | glob> ... [options]
+
+        --info              only print the header information of each image (no conversion)
+        --plain             write a plain-text P3/P2 image instead of binary P6/P5
+        -o, --output-dir    write the images into this directory (default: next to each input)
+        --no-verify         skip the CRC-32 / ADLER-32 checks
+        -j, --workers       number of worker processes (default: number of CPUs)
+        --inflate           zlib (default) or native (pure-Python inflater, -v prints block statistics)
+        --cache             keep decoded images in this directory and reuse them (e.g. ~/.cache/png2ppm)
+        --cache-size        max. size of the cache directory in MB (default: 1024)
+        -v, --verbose       log the steps and details of each image (-vv: and every chunk)
+        --profile           write the time, bytes and calls of every stage as JSON into this file
+                            (- = stdout; the summary then goes to stderr)
+        --trace-memory      with --profile, also track the peak memory of every stage (slow)
+
+        python3 Playground.py --to-png <ppm_path | directory | glob> ... [options]
+
+        --interlace         write Adam7 interlaced images
+        --level             zlib compression level, 0-9 (default: 6)
+        --idat-size         max. bytes of data per IDAT chunk (default: 65536)
 """
 
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import logging
+import os
+import struct
 import sys
+import time
+import tracemalloc
+import typing
 import zlib
 
-file = sys.argv[1] # get file path
+import numpy as np
 
-(fileName, extName) = file.rsplit('.', maxsplit=1)
+# =================================================================================
+# Instrumentation
+#
+# - off by default: nothing is measured unless an Instrumentation is active (see
+#   instrumented()); a stage then costs one global lookup per call.
+# - the pipeline stages are marked with @timed_stage(name) (or with stage_timer(name)
+#   around a block); the same name may mark several functions, e.g. 'unfilter'.
+# - stages nest, e.g. write pulls rows through deserialize, unfilter, inflate and
+#   parse; the time of a stage is its own time only (the stages it calls pause it).
+# - a generator stage is timed on every resumption, so the time the consumer spends
+#   between two items is not counted in it; calls = number of resumptions.
+# - traceMemory = track the peak memory allocated by Python (tracemalloc) while each
+#   stage runs; this slows everything down a lot.
+# - counters: bytes and items passing through the pipeline (compressedBytesIn,
+#   inflatedBytesOut, pixelBytesWritten, ...).
+# - results: to_dict() / to_json(), and each finished run is logged as JSON through
+#   the "Playground.profile" logger; the "Playground" loggers have no handler of
+#   their own, so nothing is output unless the application configures logging
+#   (main() does with -v).
+# - one run at a time per process: the active Instrumentation is a global.
+# =================================================================================
+logger = logging.getLogger("Playground")
+logger.addHandler(logging.NullHandler())
+profileLogger = logging.getLogger("Playground.profile")
+
+class Instrumentation:
+
+    def __init__(self, traceMemory=False):
+        self._traceMemory = traceMemory
+        self._stages = {}               # name => {'calls': n, 'seconds': s, 'peakBytes': b or None}
+        self._counters = {}             # name => count
+        self._running = []              # [name, startTime] of each stage running, innermost last
+        self._seconds = 0.0
+        self._peakBytes = None
+        self._startTime = None
+        self._startedTracemalloc = False
+        pass
+
+    # --- accessors ---
+    def get_stages(self):
+        return self._stages
+
+    def get_counters(self):
+        return self._counters
 
-contents = ""
+    def get_seconds(self):
+        return self._seconds
+
+    def get_peak_bytes(self):
+        return self._peakBytes
+
+    # --- mutators ---
+    def start(self):
+        if self._traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._startedTracemalloc = True
+            tracemalloc.reset_peak()
+        self._startTime = time.perf_counter()
+
+    def stop(self):
+        self._seconds += time.perf_counter() - self._startTime
+        if self._traceMemory:
+            self._add_peak(None)
+            if self._startedTracemalloc:
+                tracemalloc.stop()
+                self._startedTracemalloc = False
+
+    def enter_stage(self, name):
+        if self._traceMemory:
+            self._add_peak((self._running[-1][0]) if (self._running) else (None))
+
+        now = time.perf_counter()
+        if self._running:   # pause the stage calling this one
+            (outerName, startTime) = self._running[-1]
+            self._get_stage(outerName)['seconds'] += now - startTime
+        self._running.append([name, now])
+
+    def exit_stage(self):
+        now = time.perf_counter()
+        (name, startTime) = self._running.pop()
+        stage = self._get_stage(name)
+        stage['calls'] += 1
+        stage['seconds'] += now - startTime
+        if self._running:   # resume the stage calling this one
+            self._running[-1][1] = now
+
+        if self._traceMemory:
+            self._add_peak(name)
+
+    def add_count(self, name, count=1):
+        self._counters[name] = self._counters.get(name, 0) + count
+
+    def merge(self, other):
+        for (name, otherStage) in other.get_stages().items():
+            stage = self._get_stage(name)
+            stage['calls'] += otherStage['calls']
+            stage['seconds'] += otherStage['seconds']
+            stage['peakBytes'] = _max_bytes(stage['peakBytes'], otherStage['peakBytes'])
+        for (name, count) in other.get_counters().items():
+            self.add_count(name, count)
+        self._seconds += other.get_seconds()
+        self._peakBytes = _max_bytes(self._peakBytes, other.get_peak_bytes())
+
+    def to_dict(self):
+        return {
+            'seconds': self._seconds,
+            'peakBytes': self._peakBytes,
+            'stages': {name: dict(stage) for (name, stage) in self._stages.items()},
+            'counters': dict(self._counters)
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def format(self):
+        stages = ", ".join(
+            "{0} {1:.1f} ms".format(name, stage['seconds'] * 1000) for (name, stage) in self._stages.items()
+        )
+        counters = ", ".join("{0} {1}".format(name, count) for (name, count) in self._counters.items())
+        peak = ("; peak {0:.1f} MB".format(self._peakBytes / (1 << 20))) if (self._peakBytes is not None) else ("")
+        return "{0:.1f} ms ({1}); {2}{3}".format(self._seconds * 1000, stages, counters, peak)
+
+    def _get_stage(self, name):
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages[name] = {'calls': 0, 'seconds': 0.0, 'peakBytes': None}
+        return stage
+
+    # the peak since the last call is charged to stage name (None => to no stage)
+    def _add_peak(self, name):
+        peakBytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        self._peakBytes = _max_bytes(self._peakBytes, peakBytes)
+        if name is not None:
+            stage = self._get_stage(name)
+            stage['peakBytes'] = _max_bytes(stage['peakBytes'], peakBytes)
+
+def _max_bytes(a, b):
+    return (b) if (a is None) else ((a) if (b is None) else (max(a, b)))
+
+_instrumentation = None     # the active Instrumentation, or None (off)
+
+def get_instrumentation():
+    return _instrumentation
+
+# - makes instrumentation the active one for the block, then logs it; None => off
+#   (e.g. with instrumented(Instrumentation(traceMemory=True)) as instrumentation: ...).
+@contextlib.contextmanager
+def instrumented(instrumentation):
+    global _instrumentation
+    if instrumentation is None:
+        yield None
+        return
+
+    previous = _instrumentation
+    _instrumentation = instrumentation
+    instrumentation.start()
+    try:
+        yield instrumentation
+    finally:
+        instrumentation.stop()
+        _instrumentation = previous
+        if profileLogger.isEnabledFor(logging.INFO):
+            profileLogger.info(instrumentation.to_json())
+
+# times the block as stage name
+@contextlib.contextmanager
+def stage_timer(name):
+    instrumentation = _instrumentation
+    if instrumentation is None:
+        yield
+        return
+
+    instrumentation.enter_stage(name)
+    try:
+        yield
+    finally:
+        instrumentation.exit_stage()
+
+# decorator; times every call of the function (every resumption of a generator) as stage name
+def timed_stage(name):
+    def decorate(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                return (generator) if (_instrumentation is None) else (_iter_timed(name, generator, _instrumentation))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                instrumentation = _instrumentation
+                if instrumentation is None:
+                    return function(*args, **kwargs)
+
+                instrumentation.enter_stage(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    instrumentation.exit_stage()
+        return wrapper
+    return decorate
+
+# passes the items (and the return value) of generator through, timing each resumption
+def _iter_timed(name, generator, instrumentation):
+    try:
+        while True:
+            instrumentation.enter_stage(name)
+            try:
+                item = next(generator)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                instrumentation.exit_stage()
+            yield item
+    finally:
+        generator.close()
+
+# adds count to counter name of the active Instrumentation, if any
+def add_count(name, count=1):
+    if _instrumentation is not None:
+        _instrumentation.add_count(name, count)
 
 # =================================================================================
 # Classes and Functions
@@ -24,15 +278,22 @@ contents = ""
 # A. PNG Data Stream
 #
 # - to store all chunks in the image. 
+# - chunks are dispatched on their 4-byte type with one dictionary lookup.
+# - ancillary chunks other than tRNS are kept as they are (raw data), in order;
+#   an unknown critical chunk cannot be skipped, so it is an error.
 # ---------------------------------------------------------------------------------
 class PngDatastream:
 
+    __slots__ = ('_signature', '_idhrChunk', '_plteChunk', '_trnsChunk', '_idatChunk', '_iendChunk', '_ancillaryChunks')
+
     def __init__(self):
         self._signature = None
         self._idhrChunk = None
         self._plteChunk = None
+        self._trnsChunk = None
         self._idatChunk = None
         self._iendChunk = None
+        self._ancillaryChunks = []  # any other ancillary chunks, e.g. gAMA, tEXt
         pass
 
     # --- accessors ---
@@ -45,33 +306,26 @@ class PngDatastream:
     def get_plte_chunk(self):
         return self._plteChunk
 
+    def get_trns_chunk(self):
+        return self._trnsChunk
+
     def get_idat_chunk(self):
         return self._idatChunk
 
     def get_iend_chunk(self):
         return self._iendChunk
 
+    def get_ancillary_chunks(self):
+        return self._ancillaryChunks
+
     # --- mutators ---
     def set_signature(self, signature):
         self._signature = signature
 
     # interface of chunk setter
     def set_chunk(self, chunk):
-        setter = self._get_setter(chunk.get_type())
-        setter(chunk)
-        
-    # factory; reuse _get_chunk_creator()
-    def _get_setter(self, chunkType):
-        if chunkType == '49484452' or chunkType == 'IHDR' or chunkType == 'ihdr': # IHDR Chunk
-            return self._set_idhr_chunk
-        elif chunkType == '504C5445' or chunkType == 'PLTE' or chunkType == 'plte': # PLTE Chunk
-            return self._set_plte_chunk
-        elif chunkType == '49444154' or chunkType == 'IDAT' or chunkType == 'idat': # IDAT Chunk(s)
-            return self._set_idat_chunk
-        elif chunkType == '49454E44' or chunkType == 'IEND' or chunkType == 'iend': # IEND Chunk
-            return self._set_iend_chunk
-        else:
-            raise ValueError(chunkType)
+        setter = self._chunkSetters.get(chunk.get_type(), PngDatastream._add_other_chunk)
+        setter(self, chunk)
 
     def _set_idhr_chunk(self, idhrChunk):
         self._idhrChunk = idhrChunk
@@ -79,6 +333,9 @@ class PngDatastream:
     def _set_plte_chunk(self, plteChunk):
         self._plteChunk = plteChunk
 
+    def _set_trns_chunk(self, trnsChunk):
+        self._trnsChunk = trnsChunk
+
     def _set_idat_chunk(self, idatChunk):
         self._idatChunk = [] if (self._idatChunk is None) else (self._idatChunk)
         self._idatChunk.append(idatChunk)
@@ -86,35 +343,68 @@ class PngDatastream:
     def _set_iend_chunk(self, iendChunk):
         self._iendChunk = iendChunk
 
+    def _add_other_chunk(self, chunk):
+        if is_critical_chunk_type(chunk.get_type()):
+            raise ValueError("Unknown critical chunk: {0}".format(format_chunk_type(chunk.get_type())))
+        self._ancillaryChunks.append(chunk)
+
+    # chunk type => setter
+    _chunkSetters = {
+        b'IHDR': _set_idhr_chunk,
+        b'PLTE': _set_plte_chunk,
+        b'tRNS': _set_trns_chunk,
+        b'IDAT': _set_idat_chunk,
+        b'IEND': _set_iend_chunk
+    }
+
+# bit 5 of the first byte (lowercase letter) is 0 => critical; 1 => ancillary
+def is_critical_chunk_type(chunkType):
+    return chunkType[0] & 0x20 == 0
+
+# chunk type => printable name, e.g. b'IHDR' => 'IHDR'
+def format_chunk_type(chunkType):
+    return chunkType.decode('latin-1')
+
 # ---------------------------------------------------------------------------------
 # A2. Chunk
 # 
-# - Factor Pattern for object creation
+# - Factor Pattern for object creation; the class of each chunk type is looked up
+#   in CHUNK_CLASSES, keyed on the 4-byte type. Any other type is a plain Chunk
+#   holding the raw data slice.
 # - if not having __init__(self) in subclass, super class's __init__(self) is called
 # - reference: Understanding Class Inheritance in Python 3
 #   https://www.digitalocean.com/community/tutorials/understanding-class-inheritance-in-python-3
+# - __slots__: no per-instance __dict__, which matters for files made of
+#   thousands of small IDAT chunks; subclasses add no fields (empty __slots__).
 # ---------------------------------------------------------------------------------
 class Chunk:
 
+    __slots__ = ('_length', '_chunkType', '_chunkData', '_crc')
+
     def __init__(self):
         self._length = None         # 4-bytes; unsigned int; for _chunkData; valid values: 0 ~ 2^(31) - 1
-        self._chunkType = None      # 4-bytes (8 hex characters); hex string values
-        self._chunkData = None      # _length-bytes; dictionary or None
-        self._crc = None            # 4-bytes (8 hex characters); hex string values; for _chunkType and _chunkData
+        self._chunkType = None      # 4-bytes; bytes, e.g. b'IHDR'
+        self._chunkData = None      # _length-bytes; IhdrData, ndarray, or memoryview slice of the file buffer (zero-copy)
+        self._crc = None            # 4-bytes; unsigned int; for _chunkType and _chunkData
         pass
 
     # Factory Pattern 
     @staticmethod
     def create(chunkType):
-        creator = _get_chunk_creator(chunkType)
+        creator = CHUNK_CLASSES.get(chunkType, Chunk)
         return creator()
 
     # - this is called when child class has no overriding, i.e. no data field.
     # - None is returned
-    # - length = data length
-    def extract_data(self, length, hexChunkData):
+    # - length = data length; chunkData = memoryview of the data field
+    def extract_data(self, length, chunkData):
         return None 
 
+    # - reverse of extract_data(); chunkData => bytes-like data field (for writing).
+    # - this is called when child class has no overriding, i.e. the data is raw bytes.
+    def pack_data(self, chunkData):
+        return (b"") if (chunkData is None) else (chunkData)
+
     # --- accessors ---
     def get_length(self):
         return self._length
@@ -141,83 +431,84 @@ class Chunk:
     def set_crc(self, crc):
         self._crc = crc
 
-# used by Chunk class
-def _get_chunk_creator(chunkType):
-    if chunkType == '49484452' or chunkType == 'IHDR' or chunkType == 'ihdr': # IHDR Chunk
-        return IdhrChunk
-    elif chunkType == '504C5445' or chunkType == 'PLTE' or chunkType == 'plte': # PLTE Chunk
-        return PlteChunk
-    elif chunkType == '49444154' or chunkType == 'IDAT' or chunkType == 'idat': # IDAT Chunk(s)
-        return IdatChunk
-    elif chunkType == '49454E44' or chunkType == 'IEND' or chunkType == 'iend': # IEND Chunk
-        return IendChunk
-    else:
-        raise ValueError(chunkType)
+# data field of IHDR
+class IhdrData(typing.NamedTuple):
+    width: int              # 4-bytes; unsigned int; 0 is invalid
+    height: int             # 4-bytes; unsigned int; 0 is invalid
+    bitDepth: int           # 1-byte; int; number of bits per sample; valid values = 1,2,4,8,16; not all values allowed for all colour types.
+    colourType: int         # 1-byte; int; PNG image type; valid values = 0,2,3,4,6
+    compressionMethod: int  # 1-byte; int; method to compress the image data; (#)valid value = 0(#); 
+    filterMethod: int       # 1-byte; int; preprocessing method applied before compresson; (#)valid value = 0(#); 
+    interlaceMethod: int    # 1-byte; int; transmission order of the image data before compresson; valid value = 0 (no interlace) or 1 (Adam7 interlace).
+
+IHDR_FORMAT = struct.Struct(">IIBBBBB")
 
 class IdhrChunk(Chunk):
+
+    __slots__ = ()
     
     # override
-    def extract_data(self, length, hexChunkData):
-        data = {
-            'width': None,              # 4-bytes; unsigned int; 0 is invalid
-            'height': None,             # 4-bytes; unsigned int; 0 is invalid
-            'bitDepth': None,           # 1-byte; int; number of bits per sample; valid values = 1,2,4,8,16; not all values allowed for all colour types.
-            'colourType': None,         # 1-byte; int; PNG image type; valid values = 0,2,3,4,6
-            'compressionMethod': None,  # 1-byte; int; method to compress the image data; (#)valid value = 0(#); 
-            'filterMethod': None,       # 1-byte; int; preprocessing method applied before compresson; (#)valid value = 0(#); 
-            'interlaceMethod': None     # 1-byte; int; transmission order of the image data before compresson; valid value = 0 (no interlace) or 1 (Adam7 interlace).
-        }
-
-        assert (data['width'] is None), "Not None!!"
-        assert (data['height'] is None), "Not None!!"
-        assert (data['bitDepth'] is None), "Not None!!"
-        assert (data['colourType'] is None), "Not None!!"
-        assert (data['compressionMethod'] is None), "Not None!!"
-        assert (data['filterMethod'] is None), "Not None!!"
-        assert (data['interlaceMethod'] is None), "Not None!!"
-
-        # data length must be 13 bytes (26 hex) in IHDR
-        if len(hexChunkData) == length * 2 and length == 13:
-            data['width'] = int(hexChunkData[0:8], 16)
-            data['height'] = int(hexChunkData[8:16], 16)
-            data['bitDepth'] = int(hexChunkData[16:18], 16)
-            data['colourType'] = int(hexChunkData[18:20], 16)
-            data['compressionMethod'] = int(hexChunkData[20:22], 16)
-            data['filterMethod'] = int(hexChunkData[22:24], 16)
-            data['interlaceMethod'] = int(hexChunkData[24:26], 16)
-            return data
+    def extract_data(self, length, chunkData):
+        # data length must be 13 bytes in IHDR
+        if len(chunkData) == length and length == IHDR_FORMAT.size:
+            return IhdrData._make(IHDR_FORMAT.unpack_from(chunkData))
         else:
-            raise ValueError("{0} {1}".format(len(hexChunkData), length))
+            raise ValueError("{0} {1}".format(len(chunkData), length))
+
+    # override
+    def pack_data(self, chunkData):
+        return IHDR_FORMAT.pack(*chunkData)
 
 class PlteChunk(Chunk):
+
+    __slots__ = ()
     
     # override
-    def extract_data(self, length, hexChunkData):
-        data = {
-            'red': None,            # 1-byte; unsigned int; 0 is invalid
-            'green': None,          # 1-byte; unsigned int; 0 is invalid
-            'blue': None,           # 1-byte; int; number of bits per sample; valid values = 1,2,4,8,16; not all values allowed for all colour types.
-        }
+    # - palette entries as an N-by-3 array (red, green, blue), 1-byte each; 1 <= N <= 256
+    def extract_data(self, length, chunkData):
+        # data length must be divisible by 3 in PLTE
+        if len(chunkData) == length and length % 3 == 0 and 3 <= length <= 3 * 256:
+            return np.frombuffer(chunkData, dtype=np.uint8).reshape(-1, 3)
+        else:
+            raise ValueError("{0} {1}".format(len(chunkData), length))
+
+    # override
+    def pack_data(self, chunkData):
+        return np.ascontiguousarray(chunkData, dtype=np.uint8).tobytes()
 
-        assert (data['red'] is None), "Not None!!"
-        assert (data['green'] is None), "Not None!!"
-        assert (data['blue'] is None), "Not None!!"
+# - transparency; raw 1-byte values, interpreted by colour type:
+#   colour type 3 = one alpha value per palette entry (may be shorter than PLTE);
+#   colour type 0 / 2 = a single transparent grey / RGB value (2-bytes per sample).
+class TrnsChunk(Chunk):
 
-        # data length must be 3 bytes (6 hex) in PLTE (must be divisible by 3)
-        if len(hexChunkData) == length * 2 and length == 3:
-            data['red'] = int(hexChunkData[0:2], 16)
-            data['green'] = int(hexChunkData[2:4], 16)
-            data['blue'] = int(hexChunkData[4:6], 16)
-            return data
+    __slots__ = ()
+
+    # override
+    def extract_data(self, length, chunkData):
+        if len(chunkData) == length:
+            return np.frombuffer(chunkData, dtype=np.uint8)
         else:
-            raise ValueError("{0} {1}".format(len(hexChunkData), length))
+            raise ValueError("{0} {1}".format(len(chunkData), length))
+
+    # override
+    def pack_data(self, chunkData):
+        return np.ascontiguousarray(chunkData, dtype=np.uint8).tobytes()
 
 class IdatChunk(Chunk):
-    pass
+    __slots__ = ()
 
 # no chunk data, i.e. no need to extract data
 class IendChunk(Chunk):
-    pass
+    __slots__ = ()
+
+# chunk type => Chunk class (used by Chunk.create())
+CHUNK_CLASSES = {
+    b'IHDR': IdhrChunk,
+    b'PLTE': PlteChunk,
+    b'tRNS': TrnsChunk,
+    b'IDAT': IdatChunk,
+    b'IEND': IendChunk
+}
 
 # ---------------------------------------------------------------------------------
 # B. Zlib Data Stream
@@ -227,8 +518,8 @@ class IendChunk(Chunk):
 # - [!] naming may need to be improved.
 #   (nov/26): update naming convensions based
 # - ZLIB Compressed Data Format Specification: https://www.ietf.org/rfc/rfc1950.txt
-# - (ignore - _flags - nov/26): for now, ignore validation checking for on _flags.
-# - (ignore - _checkValue - nov/26): for now, ignore Adler32 checksum
+# - _flags: FCHECK is verified together with the data (see check_zlib_header()).
+# - _checkValue: ADLER-32 of the inflated data; verified unless verification is off.
 # - DEFLATE Compressed Data Format Specification v1.3: https://tools.ietf.org/html/rfc1951
 # - max. size of a zlib datastream  = size of concatenation result of all IDAT chunks 
 #                                   = 32k bits 
@@ -237,10 +528,9 @@ class IendChunk(Chunk):
 class ZlibDatastream:
     
     def __init__(self):
-        self._compressionDetails = None # 1-byte; 2 hex chars; right hex (bits 0-3) = Compression method (CM=8 => "deflate" CM with a window size up to 32K, used by gzip and PNG), left hex (bits 4-7) = Compression info (only defined when CM=8; when CM=8, CINFO is the base-2 log of the LZ77 window size; CINFO <= 7; CINFO=7 => 32K window size).
-        self._flags = None              # 1-byte; 2 hex chars; bits 0-4 = FCHECK, bit 5 = FDICT, bit 6-7 = FLEVEL
-        self._compressedData = None     # n-bytes; 2*n hex chars; CM=8 => "deflate compressed data format"
-        self._checkValue = None         # 4-bytes; 8 hex chars; ADLER-32 Checksum
+        self._compressionDetails = None # 1-byte; right hex (bits 0-3) = Compression method (CM=8 => "deflate" CM with a window size up to 32K, used by gzip and PNG), left hex (bits 4-7) = Compression info (only defined when CM=8; when CM=8, CINFO is the base-2 log of the LZ77 window size; CINFO <= 7; CINFO=7 => 32K window size).
+        self._flags = None              # 1-byte; bits 0-4 = FCHECK, bit 5 = FDICT, bit 6-7 = FLEVEL
+        self._checkValue = None         # 4-bytes; memoryview; ADLER-32 Checksum
         pass
 
     # --- mutators ---
@@ -250,9 +540,6 @@ class ZlibDatastream:
     def get_flags(self):
         return self._flags
 
-    def get_compressed_data(self):
-        return self._compressedData
-
     def get_check_value(self):
         return self._checkValue
 
@@ -263,208 +550,2247 @@ class ZlibDatastream:
     def set_flags(self, flags):
         self._flags = flags
 
-    def set_compressed_data(self, data):
-        self._compressedData = data
-
     def set_check_value(self, value):
         self._checkValue = value
 
 # ---------------------------------------------------------------------------------
-# Y. Bits
+# C. Chunk Reader
+#
+# - walks a memoryview over the raw file instead of a hex string; every field is
+#   read in place with struct.unpack_from.
+# - chunk data is a zero-copy slice of the file buffer, so the only copy made
+#   while parsing is the one needed to join the IDAT data for zlib.
+# - chunk layout: Length (4 bytes) | Chunk Type (4 bytes) | Chunk Data (Length bytes) | CRC (4 bytes)
+# ---------------------------------------------------------------------------------
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"                    # png must begin with this eight bytes
+CRITICAL_CHUNK_TYPES = (b'IHDR', b'PLTE', b'IDAT', b'IEND')
+KNOWN_CHUNK_TYPES = CRITICAL_CHUNK_TYPES + (b'tRNS',)
+
+# yields (chunkStartIdx, length, chunkType, chunkData, crc) for every chunk in buffer
+@timed_stage('parse')
+def iter_chunk_fields(buffer):
+    view = memoryview(buffer)
+    if view[0:8] != PNG_SIGNATURE:
+        raise ValueError(bytes(view[0:8]).hex().upper())
+
+    chunkStartIdx = 8
+    while chunkStartIdx != len(view):
+        if chunkStartIdx + 12 > len(view):
+            raise ValueError("Truncated chunk header at {0}".format(chunkStartIdx))
+
+        (length, chunkType) = struct.unpack_from(">I4s", view, chunkStartIdx)  # get Length and Chunk Type
+        dataStartIdx = chunkStartIdx + 8
+        crcStartIdx = dataStartIdx + length
+        if crcStartIdx + 4 > len(view):
+            raise ValueError("Truncated chunk data at {0}".format(chunkStartIdx))
+
+        (crc,) = struct.unpack_from(">I", view, crcStartIdx)                   # get CRC
+        add_count('chunks')
+        yield (chunkStartIdx, length, chunkType, view[dataStartIdx:crcStartIdx], crc)
+
+        # update chunk starting index (4 bytes + 4 bytes + length bytes + 4 bytes)
+        chunkStartIdx = crcStartIdx + 4
+
+# create new Chunk of corresponding type, and store the parsed fields into it
+@timed_stage('parse')
+def create_chunk(length, chunkType, chunkData, crc):
+    chunk = Chunk.create(chunkType)
+
+    # extract Chunk Data based on its type (polymorphism)
+    # if no corresponding extraction, e.g. IDAT and IEND, keep the raw data slice.
+    extractedData = chunk.extract_data(length, chunkData)
+
+    chunk.set_length(length)
+    chunk.set_type(chunkType)
+    chunk.set_data((chunkData) if (extractedData is None) else (extractedData))
+    chunk.set_crc(crc)
+    return chunk
+
+# parse a whole PNG file held in memory (bytes, bytearray, mmap, ...)
+def read_png_datastream(buffer, verify=True, stats=None):
+    pngDatastream = PngDatastream()
+    pngDatastream.set_signature(PNG_SIGNATURE)
+
+    chunkFields = iter_chunk_fields(buffer)
+    if verify:
+        chunkFields = iter_verified_chunk_fields(chunkFields, stats)
+
+    for (chunkStartIdx, length, chunkType, chunkData, crc) in chunkFields:
+        logger.debug("chunkStartIdx: %d (%s, %d bytes)", chunkStartIdx, format_chunk_type(chunkType), length)
+        pngDatastream.set_chunk(create_chunk(length, chunkType, chunkData, crc))
+
+    return pngDatastream
+
+# - yields the same fields as iter_chunk_fields(), but reads the chunks one at a time
+#   from a file object, so only one chunk is held in memory.
+# - readTypes = chunk types whose data is read (None => all); the data and CRC of any
+#   other chunk are skipped with a seek, and yielded as None.
+@timed_stage('parse')
+def iter_file_chunk_fields(f, readTypes=None):
+    signature = f.read(8)
+    add_count('fileBytesRead', len(signature))
+    if signature != PNG_SIGNATURE:
+        raise ValueError(signature.hex().upper())
+
+    if readTypes is not None:
+        fileSize = f.seek(0, io.SEEK_END)
+        f.seek(8)
+
+    chunkStartIdx = 8
+    while True:
+        header = f.read(8)
+        add_count('fileBytesRead', len(header))
+        if len(header) == 0:
+            return
+        if len(header) != 8:
+            raise ValueError("Truncated chunk header at {0}".format(chunkStartIdx))
+
+        (length, chunkType) = struct.unpack(">I4s", header)                    # get Length and Chunk Type
+
+        if readTypes is not None and chunkType not in readTypes:
+            if f.seek(length + 4, io.SEEK_CUR) > fileSize:                      # skip Chunk Data and CRC
+                raise ValueError("Truncated chunk data at {0}".format(chunkStartIdx))
+            yield (chunkStartIdx, length, chunkType, None, None)
+            chunkStartIdx += 12 + length
+            continue
+
+        chunkData = f.read(length)                                              # get Chunk Data
+        crc = f.read(4)                                                         # get CRC
+        add_count('fileBytesRead', len(chunkData) + len(crc))
+        if len(chunkData) != length or len(crc) != 4:
+            raise ValueError("Truncated chunk data at {0}".format(chunkStartIdx))
+
+        add_count('chunks')
+        yield (chunkStartIdx, length, chunkType, memoryview(chunkData), struct.unpack(">I", crc)[0])
+        chunkStartIdx += 12 + length
+
+# - stores every chunk except IDAT into pngDatastream, and yields the data of each
+#   IDAT chunk as it arrives.
+# - IDAT chunks are not kept, so memory does not grow with the number of IDAT chunks.
+def iter_idat_data(chunkFields, pngDatastream):
+    for (chunkStartIdx, length, chunkType, chunkData, crc) in chunkFields:
+        logger.debug("chunkStartIdx: %d (%s, %d bytes)", chunkStartIdx, format_chunk_type(chunkType), length)
+
+        if chunkType == b'IDAT':
+            yield chunkData
+        else:
+            pngDatastream.set_chunk(create_chunk(length, chunkType, chunkData, crc))
+
 # ---------------------------------------------------------------------------------
-# assume it is a hex value
-def get_bit(target, n, bitRange=4):
-    if (
-        (target is not None) and (n in range(0,bitRange)) and (type(target) == str) and 
-        (target.isdigit() or (target.upper() >= 'A' and target.upper() <= 'F'))
-    ):
-        return (1) if (int(target, 16) & (1 << n) > 0) else (0)
+# C2. Integrity Checks
+#
+# - CRC-32 of every chunk (over chunk type + chunk data) is checked as the chunk
+#   is read, and ADLER-32 of the zlib datastream is updated as the data is
+#   inflated; both use the table-driven implementations of zlib, so neither
+#   needs a second pass over the data.
+# - IntegrityStats counts how many bytes were checked and how long it took, so
+#   the cost of verification can be compared with verification turned off.
+# ---------------------------------------------------------------------------------
+class IntegrityStats:
+
+    def __init__(self):
+        self._crcChunks = 0         # number of chunks checked
+        self._crcBytes = 0          # bytes of chunk data checked
+        self._crcSeconds = 0.0
+        self._adlerBytes = 0        # bytes of inflated data checked
+        self._adlerSeconds = 0.0
+        pass
+
+    # --- accessors ---
+    def get_crc_chunks(self):
+        return self._crcChunks
+
+    def get_crc_bytes(self):
+        return self._crcBytes
+
+    def get_crc_seconds(self):
+        return self._crcSeconds
+
+    def get_adler_bytes(self):
+        return self._adlerBytes
+
+    def get_adler_seconds(self):
+        return self._adlerSeconds
+
+    # --- mutators ---
+    def add_crc(self, byteCount, seconds):
+        self._crcChunks += 1
+        self._crcBytes += byteCount
+        self._crcSeconds += seconds
+
+    def add_adler(self, byteCount, seconds):
+        self._adlerBytes += byteCount
+        self._adlerSeconds += seconds
+
+    def merge(self, other):
+        self._crcChunks += other.get_crc_chunks()
+        self._crcBytes += other.get_crc_bytes()
+        self._crcSeconds += other.get_crc_seconds()
+        self._adlerBytes += other.get_adler_bytes()
+        self._adlerSeconds += other.get_adler_seconds()
+
+    def format(self):
+        return "CRC-32: {0} chunks / {1} bytes in {2:.3f} ms, ADLER-32: {3} bytes in {4:.3f} ms".format(
+            self._crcChunks, self._crcBytes, self._crcSeconds * 1000, self._adlerBytes, self._adlerSeconds * 1000
+        )
+
+# passes chunk fields through, checking the CRC of every chunk whose data was read
+@timed_stage('crc')
+def iter_verified_chunk_fields(chunkFields, stats=None):
+    for (chunkStartIdx, length, chunkType, chunkData, crc) in chunkFields:
+        if chunkData is not None:
+            startTime = time.perf_counter()
+            actualCrc = zlib.crc32(chunkData, zlib.crc32(chunkType))
+            if stats is not None:
+                stats.add_crc(length, time.perf_counter() - startTime)
+
+            if actualCrc != crc:
+                raise ValueError("CRC mismatch in {0} chunk at {1}: {2:08X} {3:08X}".format(format_chunk_type(chunkType), chunkStartIdx, crc, actualCrc))
+
+        yield (chunkStartIdx, length, chunkType, chunkData, crc)
+
+def _update_adler32(data, adler, stats=None):
+    startTime = time.perf_counter()
+    adler = zlib.adler32(data, adler)
+    if stats is not None:
+        stats.add_adler(len(data), time.perf_counter() - startTime)
+    return adler
+
+# - CMF: bits 0-3 = CM (must be 8 = deflate), bits 4-7 = CINFO (<= 7).
+# - FLG: bit 5 = FDICT (must be 0 in PNG); CMF*256 + FLG must be a multiple of 31 (FCHECK).
+def check_zlib_header(streamHead, verify=True):
+    (cmf, flg) = (streamHead[0], streamHead[1])
+    if cmf & 0x0F != 8 or cmf >> 4 > 7:
+        raise ValueError("Unsupported compression method: {0:02X}".format(cmf))
+    if flg & 0x20:
+        raise ValueError("Preset dictionary not allowed: {0:02X}".format(flg))
+    if verify and ((cmf << 8) | flg) % 31 != 0:
+        raise ValueError("FCHECK mismatch: {0:02X} {1:02X}".format(cmf, flg))
+
+# ---------------------------------------------------------------------------------
+# D. Decompression
+#
+# - IDAT data is fed into a zlib.decompressobj as it arrives, in slices of at most
+#   INFLATE_INPUT_SIZE bytes, and each call inflates at most INFLATE_OUTPUT_SIZE
+#   bytes; peak memory is therefore bounded no matter how large the image is.
+# - the decompressor reads raw deflate data; the zlib header (CMF, FLG) and the
+#   ADLER-32 check value around it are handled here, so that the check can be
+#   skipped (verify=False).
+# - the zlib header and check value are recorded into the ZlibDatastream; the
+#   compressed data itself is not kept.
+# ---------------------------------------------------------------------------------
+INFLATE_INPUT_SIZE = 1 << 14
+INFLATE_OUTPUT_SIZE = 1 << 16
+
+INFLATE_BACKENDS = ('zlib', 'native')
+
+# - inflateBackend = 'zlib' (zlib.decompressobj), or 'native' (inflate_native(); per-block
+#   statistics are added to inflateStats if given).
+@timed_stage('inflate')
+def iter_inflate(compressedPieces, zlibDatastream=None, maxLength=INFLATE_OUTPUT_SIZE, verify=True, stats=None, inflateBackend='zlib', inflateStats=None):
+    if inflateBackend == 'zlib':
+        (streamHead, streamTail, adler) = yield from _iter_zlib_inflate(compressedPieces, maxLength, verify, stats)
+    elif inflateBackend == 'native':
+        (streamHead, streamTail, adler) = yield from _iter_native_inflate(compressedPieces, verify, stats, inflateStats)
     else:
-        return None
+        raise ValueError(inflateBackend)
+
+    if len(streamTail) != 4:
+        raise ValueError("Truncated zlib datastream")
+    if verify and adler != int.from_bytes(streamTail, 'big'):
+        raise ValueError("ADLER-32 mismatch: {0} {1:08X}".format(streamTail.hex().upper(), adler))
+
+    if zlibDatastream is not None:
+        zlibDatastream.set_compression_details(streamHead[0:1])
+        zlibDatastream.set_flags(streamHead[1:2])
+        zlibDatastream.set_check_value(streamTail)
+
+# yields inflated pieces; returns (streamHead, streamTail, adler)
+def _iter_zlib_inflate(compressedPieces, maxLength, verify, stats):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    streamHead = b""    # first 2 bytes of the stream: CMF, FLG
+    streamTail = b""    # 4 bytes after the deflate data: ADLER-32
+    adler = 1           # ADLER-32 of the data inflated so far
+
+    for piece in compressedPieces:
+        add_count('compressedBytesIn', len(piece))
+        if decompressor.eof: # the check value may be split across IDAT chunks
+            streamTail += bytes(piece[0 : 4-len(streamTail)])
+            if len(streamTail) == 4:
+                break
+            continue
+
+        if len(streamHead) < 2:
+            headLength = 2 - len(streamHead)
+            streamHead += bytes(piece[0:headLength])
+            piece = piece[headLength:]
+            if len(streamHead) == 2:
+                check_zlib_header(streamHead, verify)
+
+        for offset in range(0, len(piece), INFLATE_INPUT_SIZE):
+            data = piece[offset : offset+INFLATE_INPUT_SIZE]
+            while data and not decompressor.eof:
+                inflated = decompressor.decompress(data, maxLength)
+                if inflated:
+                    if verify:
+                        adler = _update_adler32(inflated, adler, stats)
+                    add_count('inflatedBytesOut', len(inflated))
+                    yield inflated
+                data = decompressor.unconsumed_tail
+
+            if decompressor.eof:
+                restStartIdx = offset + INFLATE_INPUT_SIZE
+                streamTail = (decompressor.unused_data + bytes(piece[restStartIdx : restStartIdx+4]))[0:4]
+                break
+
+        if decompressor.eof and len(streamTail) == 4:
+            break
+
+    if not decompressor.eof: # output held back by maxLength after the last input
+        inflated = decompressor.flush()
+        if inflated:
+            if verify:
+                adler = _update_adler32(inflated, adler, stats)
+            add_count('inflatedBytesOut', len(inflated))
+            yield inflated
+        streamTail = decompressor.unused_data[0:4]
+
+    if not decompressor.eof:
+        raise ValueError("Truncated zlib datastream")
+    return (streamHead, streamTail, adler)
+
+# - yields inflated pieces (one per deflate block); returns (streamHead, streamTail, adler).
+# - the native inflater works on the whole stream, so the IDAT data is joined first.
+def _iter_native_inflate(compressedPieces, verify, stats, inflateStats):
+    stream = b"".join(compressedPieces)
+    add_count('compressedBytesIn', len(stream))
+    streamHead = stream[0:2]
+    if len(streamHead) != 2:
+        raise ValueError("Truncated zlib datastream")
+    check_zlib_header(streamHead, verify)
+
+    adler = 1
+    blocks = inflate_native(memoryview(stream)[2:], inflateStats)
+    while True:
+        try:
+            inflated = next(blocks)
+        except StopIteration as stop:
+            endIdx = 2 + stop.value
+            break
+        if verify:
+            adler = _update_adler32(inflated, adler, stats)
+        add_count('inflatedBytesOut', len(inflated))
+        yield inflated
+
+    return (streamHead, stream[endIdx : endIdx+4], adler)
 
-# =================================================================================
-# Main
-# =================================================================================
+# ---------------------------------------------------------------------------------
+# D2. Native Inflate
+#
+# - pure-Python DEFLATE decoder (stored, fixed-Huffman and dynamic-Huffman blocks),
+#   usable in place of zlib; see DEFLATE Compressed Data Format Specification v1.3.
+# - bits are read from an integer bit buffer, refilled 8 bytes at a time; the
+#   stream is LSB-first, so the next bit is always bit 0 of the buffer.
+# - a Huffman code is decoded with one lookup: the table is indexed by the next
+#   maxLength bits, and every entry holds (symbol << 4) | code length. A code of
+#   length n fills every 2^n-th entry starting at its bit-reversed value.
+# - per-block statistics (block type, literal and match counts, bits read,
+#   bytes written) are collected in InflateStats.
+# ---------------------------------------------------------------------------------
+BTYPE_NAMES = {0: 'stored', 1: 'fixed', 2: 'dynamic'}
+
+LENGTH_BASE = (3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258)
+LENGTH_EXTRA = (0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0)
+DISTANCE_BASE = (1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193, 257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145, 8193, 12289, 16385, 24577)
+DISTANCE_EXTRA = (0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13)
+CODE_LENGTH_ORDER = (16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15)
+
+INVALID_CODE = 0xFFFF << 4     # table entry of a bit pattern with no code; decodes to an out-of-range symbol
+WINDOW_SIZE = 1 << 15          # LZ77 window: the most distant byte a match may refer to
+
+_fixedHuffmanTables = None
+
+class InflateStats:
+
+    def __init__(self):
+        self._blocks = []   # one dictionary per block, in order
+        pass
+
+    # --- accessors ---
+    def get_blocks(self):
+        return self._blocks
+
+    # --- mutators ---
+    def add_block(self, blockType, literals, matches, inputBits, outputBytes):
+        self._blocks.append({
+            'type': blockType,          # BTYPE; 0 = stored, 1 = fixed Huffman, 2 = dynamic Huffman
+            'literals': literals,       # number of literal symbols
+            'matches': matches,         # number of <length, distance> pairs
+            'inputBits': inputBits,     # compressed size of the block, including its header
+            'outputBytes': outputBytes  # inflated size of the block
+        })
+
+    def format(self):
+        counts = [len([block for block in self._blocks if block['type'] == blockType]) for blockType in (0, 1, 2)]
+        return "{0} blocks (stored {1}, fixed {2}, dynamic {3}), {4} literals, {5} matches".format(
+            len(self._blocks), counts[0], counts[1], counts[2],
+            sum([block['literals'] for block in self._blocks]), sum([block['matches'] for block in self._blocks])
+        )
+
+# code length of each symbol => (lookup table, maxLength)
+def build_huffman_table(codeLengths):
+    maxLength = max(codeLengths)
+    if maxLength == 0:  # no codes at all, e.g. a distance code in a block of literals only
+        return ([INVALID_CODE], 0)
+
+    # canonical Huffman codes: count codes of each length, then the first code of each length
+    lengthCounts = [0] * (maxLength + 1)
+    for length in codeLengths:
+        lengthCounts[length] += 1
+    lengthCounts[0] = 0
+
+    nextCode = [0] * (maxLength + 1)
+    code = 0
+    for bits in range(1, maxLength + 1):
+        code = (code + lengthCounts[bits - 1]) << 1
+        nextCode[bits] = code
+
+    table = [INVALID_CODE] * (1 << maxLength)
+    for (symbol, length) in enumerate(codeLengths):
+        if length == 0:
+            continue
+        code = nextCode[length]
+        nextCode[length] += 1
+        if code >= (1 << length):
+            raise ValueError("Over-subscribed Huffman code")
+
+        reversedCode = int(format(code, '0{0}b'.format(length))[::-1], 2)
+        table[reversedCode :: 1 << length] = [(symbol << 4) | length] * (1 << (maxLength - length))
+
+    return (table, maxLength)
+
+def _get_fixed_huffman_tables():
+    global _fixedHuffmanTables
+    if _fixedHuffmanTables is None:
+        _fixedHuffmanTables = (
+            build_huffman_table([8] * 144 + [9] * 112 + [7] * 24 + [8] * 8),   # literal/length codes 0-287
+            build_huffman_table([5] * 30)                                       # distance codes 0-29
+        )
+    return _fixedHuffmanTables
+
+# - data = raw deflate data (bytes-like); yields the inflated data of each block,
+#   and returns the number of bytes of data used (the rest is not deflate data).
+def inflate_native(data, inflateStats=None):
+    data = bytes(data)
+    out = bytearray()       # inflated data not yielded yet, after the last WINDOW_SIZE bytes already yielded
+    emittedIdx = 0          # out[emittedIdx:] is not yielded yet
+    pos = 0                 # next byte of data to load into bitBuf
+    bitBuf = 0
+    bitCount = 0
+
+    isFinal = 0
+    while not isFinal:
+        if bitCount < 3:
+            chunk = data[pos : pos+8]
+            bitBuf |= int.from_bytes(chunk, 'little') << bitCount
+            bitCount += 8 * len(chunk)
+            pos += len(chunk)
+            if bitCount < 3:
+                raise ValueError("Truncated deflate data")
+
+        blockStartBits = 8 * pos - bitCount
+        blockStartIdx = len(out)
+        literals = 0
+        matches = 0
+
+        isFinal = bitBuf & 1            # BFINAL
+        blockType = (bitBuf >> 1) & 3   # BTYPE
+        bitBuf >>= 3
+        bitCount -= 3
+
+        if blockType == 0: # stored: skip to the byte boundary, then LEN, NLEN and LEN bytes of data
+            pos -= bitCount // 8
+            bitBuf = 0
+            bitCount = 0
+            if pos + 4 > len(data):
+                raise ValueError("Truncated deflate data")
+            (length, nlength) = struct.unpack_from("<HH", data, pos)
+            if length ^ nlength != 0xFFFF:
+                raise ValueError("Invalid stored block length: {0} {1}".format(length, nlength))
+            if pos + 4 + length > len(data):
+                raise ValueError("Truncated deflate data")
+            out += data[pos+4 : pos+4+length]
+            pos += 4 + length
+
+        elif blockType == 1 or blockType == 2:
+            if blockType == 1:
+                ((litTable, litBits), (distTable, distBits)) = _get_fixed_huffman_tables()
+            else:
+                (litTable, litBits, distTable, distBits, pos, bitBuf, bitCount) = _read_dynamic_huffman_tables(data, pos, bitBuf, bitCount)
+            litMask = (1 << litBits) - 1
+            distMask = (1 << distBits) - 1
+
+            while True:
+                if bitCount < 48: # enough for the longest code + extra bits + distance code + extra bits
+                    chunk = data[pos : pos+8]
+                    if not chunk and bitCount < 0:
+                        raise ValueError("Truncated deflate data")
+                    bitBuf |= int.from_bytes(chunk, 'little') << bitCount
+                    bitCount += 8 * len(chunk)
+                    pos += len(chunk)
+
+                entry = litTable[bitBuf & litMask]
+                codeLength = entry & 15
+                bitBuf >>= codeLength
+                bitCount -= codeLength
+                symbol = entry >> 4
+
+                if symbol < 256: # literal byte
+                    out.append(symbol)
+                    literals += 1
+                elif symbol == 256: # end of block
+                    break
+                elif symbol < 286: # <length, distance>
+                    symbol -= 257
+                    extraBits = LENGTH_EXTRA[symbol]
+                    length = LENGTH_BASE[symbol] + (bitBuf & ((1 << extraBits) - 1))
+                    bitBuf >>= extraBits
+                    bitCount -= extraBits
+
+                    entry = distTable[bitBuf & distMask]
+                    codeLength = entry & 15
+                    bitBuf >>= codeLength
+                    bitCount -= codeLength
+                    symbol = entry >> 4
+                    if symbol >= 30:
+                        raise ValueError("Invalid distance code")
+
+                    extraBits = DISTANCE_EXTRA[symbol]
+                    distance = DISTANCE_BASE[symbol] + (bitBuf & ((1 << extraBits) - 1))
+                    bitBuf >>= extraBits
+                    bitCount -= extraBits
+
+                    copyStartIdx = len(out) - distance
+                    if copyStartIdx < 0:
+                        raise ValueError("Invalid distance: {0}".format(distance))
+                    if length <= distance:
+                        out += out[copyStartIdx : copyStartIdx+length]
+                    else: # the copy overlaps its own output => repeat the last distance bytes
+                        out += (out[copyStartIdx:] * (length // distance + 1))[0:length]
+                    matches += 1
+                else:
+                    raise ValueError("Invalid literal/length code")
+
+            if bitCount < 0:
+                raise ValueError("Truncated deflate data")
+        else:
+            raise ValueError("Invalid block type: {0}".format(blockType))
+
+        if inflateStats is not None:
+            inflateStats.add_block(blockType, literals, matches, 8 * pos - bitCount - blockStartBits, len(out) - blockStartIdx)
+
+        # yield the block, and keep only the window for later matches
+        if len(out) > emittedIdx:
+            yield bytes(out[emittedIdx:])
+        if len(out) > 2 * WINDOW_SIZE:
+            del out[0 : len(out) - WINDOW_SIZE]
+        emittedIdx = len(out)
+
+    return pos - bitCount // 8
+
+# reads HLIT, HDIST, HCLEN and the code lengths of a dynamic block; returns the two tables and the bit reader state
+def _read_dynamic_huffman_tables(data, pos, bitBuf, bitCount):
+    if bitCount < 14:
+        chunk = data[pos : pos+8]
+        bitBuf |= int.from_bytes(chunk, 'little') << bitCount
+        bitCount += 8 * len(chunk)
+        pos += len(chunk)
+    literalCount = (bitBuf & 31) + 257          # HLIT + 257
+    distanceCount = ((bitBuf >> 5) & 31) + 1    # HDIST + 1
+    codeLengthCount = ((bitBuf >> 10) & 15) + 4 # HCLEN + 4
+    bitBuf >>= 14
+    bitCount -= 14
+
+    codeLengthLengths = [0] * 19
+    for i in range(0, codeLengthCount):
+        if bitCount < 3:
+            chunk = data[pos : pos+8]
+            bitBuf |= int.from_bytes(chunk, 'little') << bitCount
+            bitCount += 8 * len(chunk)
+            pos += len(chunk)
+        codeLengthLengths[CODE_LENGTH_ORDER[i]] = bitBuf & 7
+        bitBuf >>= 3
+        bitCount -= 3
+
+    (clTable, clBits) = build_huffman_table(codeLengthLengths)
+    clMask = (1 << clBits) - 1
+
+    codeLengths = []
+    while len(codeLengths) < literalCount + distanceCount:
+        if bitCount < 14:
+            chunk = data[pos : pos+8]
+            if not chunk and bitCount < 0:
+                raise ValueError("Truncated deflate data")
+            bitBuf |= int.from_bytes(chunk, 'little') << bitCount
+            bitCount += 8 * len(chunk)
+            pos += len(chunk)
+
+        entry = clTable[bitBuf & clMask]
+        bitBuf >>= entry & 15
+        bitCount -= entry & 15
+        symbol = entry >> 4
+
+        if symbol < 16: # code length 0-15
+            codeLengths.append(symbol)
+        elif symbol == 16: # copy the previous code length 3-6 times
+            if len(codeLengths) == 0:
+                raise ValueError("Invalid code length repeat")
+            codeLengths.extend([codeLengths[-1]] * (3 + (bitBuf & 3)))
+            bitBuf >>= 2
+            bitCount -= 2
+        elif symbol == 17: # repeat code length 0 for 3-10 times
+            codeLengths.extend([0] * (3 + (bitBuf & 7)))
+            bitBuf >>= 3
+            bitCount -= 3
+        elif symbol == 18: # repeat code length 0 for 11-138 times
+            codeLengths.extend([0] * (11 + (bitBuf & 127)))
+            bitBuf >>= 7
+            bitCount -= 7
+        else:
+            raise ValueError("Invalid code length code")
+
+    if len(codeLengths) != literalCount + distanceCount or codeLengths[256] == 0:
+        raise ValueError("Invalid code lengths")
+
+    (litTable, litBits) = build_huffman_table(codeLengths[0:literalCount])
+    (distTable, distBits) = build_huffman_table(codeLengths[literalCount:])
+    return (litTable, litBits, distTable, distBits, pos, bitBuf, bitCount)
 
 # ---------------------------------------------------------------------------------
-# Step 1 : Read PNG image file, and store all the chunks
+# E. Scanlines
+#
+# - a filtered scanline = filter type (1 byte) + the bytes of one row of pixels.
+# - the row size depends on colour type and bit depth; rows are padded to a whole
+#   byte when bits per pixel < 8.
 # ---------------------------------------------------------------------------------
-print("\n[*] Execute Step 1...") 
-pngDatastream = PngDatastream()
+SAMPLES_PER_PIXEL = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}    # colourType => number of samples per pixel
+BIT_DEPTHS = {                                          # colourType => allowed bit depths
+    0: (1, 2, 4, 8, 16),    # greyscale
+    2: (8, 16),             # truecolour (RGB)
+    3: (1, 2, 4, 8),        # indexed-colour (palette)
+    4: (8, 16),             # greyscale with alpha
+    6: (8, 16)              # truecolour with alpha (RGBA)
+}
+
+def get_bits_per_pixel(colourType, bitDepth):
+    if colourType not in SAMPLES_PER_PIXEL:
+        raise ValueError(colourType)
+    if bitDepth not in BIT_DEPTHS[colourType]:
+        raise ValueError("{0} {1}".format(colourType, bitDepth))
+    return SAMPLES_PER_PIXEL[colourType] * bitDepth
+
+# length of a filtered scanline in bytes (including the filter type byte)
+def get_scanline_length(width, bitsPerPixel):
+    return 1 + (width * bitsPerPixel + 7) // 8
+
+# - regroups inflated pieces into filtered scanlines; lineLengths gives the length of
+#   each scanline in order (e.g. itertools.repeat(lineLength, height)).
+# - each scanline is yielded as its own bytearray; data after the last scanline is ignored.
+@timed_stage('unfilter')
+def iter_filtered_scanlines(inflatedPieces, lineLengths):
+    pending = bytearray()
+    inflatedPieces = iter(inflatedPieces)
+
+    for lineLength in lineLengths:
+        while len(pending) < lineLength:
+            piece = next(inflatedPieces, None)
+            if piece is None:
+                raise ValueError("Not enough image data: {0} {1}".format(len(pending), lineLength))
+            pending += piece
+
+        yield pending[0:lineLength]
+        del pending[0:lineLength]
 
-# 1 byte = 8 bits = 2 * 4 bits = 2 * 1 hex digit = 2 hex digits 
-with open(file, "rb") as f:
-    hexLine = "".join([line.hex() for line in f.readlines()]).upper()  # convert bytes to hex (no need to strip line: each singel byte matters when parsing PNG format)
-    
-    if hexLine[0:16] == "89504E470D0A1A0A": # png must begin with this eight bytes
-        
-        # (optional) set png signature to the PngDatastream object
-        pngDatastream.set_signature("89504E470D0A1A0A")
-        
-        chunkStartIdx = 16
-        while chunkStartIdx != len(hexLine):
-            print("[*] chunkStartIdx: {0}".format(chunkStartIdx))
-            
-            # parse chunks
-            length = int(hexLine[chunkStartIdx : chunkStartIdx+8], 16)                  # get Length
-            hexChunkType = hexLine[chunkStartIdx+8 : chunkStartIdx+16]                  # get Chunk Type
-            hexChunkData = hexLine[chunkStartIdx+16 : chunkStartIdx+16+length*2]        # get Chunk Data (note: length -> bytes => need *2)
-            hexCrc = hexLine[chunkStartIdx+16+length*2 : chunkStartIdx+16+length*2+8]   # get CRC
-            assert (length * 2 == len(hexChunkData)), "Inconsistent Data: hex should have a double of length than byte!!"
-            assert (len(hexLine[chunkStartIdx : chunkStartIdx+8]) + len(hexChunkType) + len(hexChunkData) + len(hexCrc) == 16+length*2+8), "Inconsistent Data!"
-            
-            if hexChunkType == '49484452' or hexChunkType == '504C5445' or hexChunkType == '49444154' or hexChunkType == '49454E44': # if not critical chunk type, skip.
-                # create new Chunk of corresponding type
-                chunk = Chunk.create(hexChunkType)
-                assert (chunk.get_length() is None), "Wrong Value!!"
-                assert (chunk.get_type() is None), "Wrong Value!!"
-                assert (chunk.get_data() is None), "Wrong Value!!"
-                assert (chunk.get_crc() is None), "Wrong Value!!"
-                
-                # extract Chunk Data based on its type (polymorphism)
-                # if no corresponding extraction, e.g. IDAT and IEND, use the original hex data.
-                chunkData = chunk.extract_data(length, hexChunkData)
-                chunkData = (hexChunkData) if (chunkData is None) else (chunkData)
-
-                # store information into Chunk object
-                chunk.set_length(length)
-                chunk.set_type(hexChunkType)
-                chunk.set_data(chunkData)
-                chunk.set_crc(hexCrc)
-                assert (chunk.get_length() == length), "Wrong Value!!"
-                assert (chunk.get_type() == hexChunkType), "Wrong Value!!"
-                assert (chunk.get_data() == chunkData), "Wrong Value!!"
-                assert (chunk.get_crc() == hexCrc), "Wrong Value!!"
-
-                # store Chunk object into PngDatastream object
-                pngDatastream.set_chunk(chunk)
-
-            # update chunk starting index (4 bytes + 4 bytes + length bytes + 4 bytes = 2 * (4 + 4 + length + 4) = 16 + length*2 + 8
-            chunkStartIdx += 16 + length*2 + 8
-            
+# ---------------------------------------------------------------------------------
+# F. Reconstruction (Un-filter)
+#
+# - filter types: None (0), Sub (1), Up (2), Average (3), Paeth (4).
+# - a = byte of the pixel to the left (bpp bytes back), b = byte above, c = byte
+#   above-left; bytes outside the image are 0; arithmetic is modulo 256, which
+#   uint8 arrays do for free.
+# - None and Up are whole-row vector operations. Sub is a cumulative sum over the
+#   row, taken separately for each byte position within a pixel.
+# - Average and Paeth depend on the reconstructed byte to the left, so a row is a
+#   recurrence. The rows from the first to the last Average / Paeth row of a band
+#   are reconstructed one anti-diagonal at a time instead, whatever the filters of
+#   the rows in between: every pixel on a diagonal only depends on the two
+#   diagonals before it, so each step is one vector operation over all rows, with
+#   the predictor of each row chosen by its filter type.
+# - a wavefront covers at most UNFILTER_BAND_SIZE rows (its arrays grow with rows x
+#   (rows + pixels per row)); longer inputs are un-filtered band by band.
+# - a wavefront takes rows + pixels per row steps, so when there are few rows for
+#   the width of the image (e.g. a short last band, or a 1-pixel wide image) the
+#   rows are reconstructed byte by byte instead.
+# ---------------------------------------------------------------------------------
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+
+UNFILTER_BAND_SIZE = 256    # rows un-filtered together (when streaming, and at most per wavefront)
+WAVEFRONT_COST = 100        # one anti-diagonal step costs about as much as un-filtering this many bytes one by one
+
+# bytes per complete pixel, rounded up to 1 (the "bpp" of the filter functions)
+def get_filter_unit(bitsPerPixel):
+    return max(1, bitsPerPixel // 8)
+
+# un-filter one None / Sub / Up scanline (without its filter type byte); prior = previous reconstructed scanline
+def unfilter_scanline(filterType, line, prior, bpp):
+    if filterType == FILTER_NONE:
+        return line.copy()
+    elif filterType == FILTER_SUB:
+        return np.cumsum(line.reshape(-1, bpp), axis=0, dtype=np.uint8).reshape(-1)
+    elif filterType == FILTER_UP:
+        return line + prior
     else:
-        raise ValueError(hexLine[0:16])
+        raise ValueError(filterType)
+
+# - un-filter scanlines of any filter types one byte at a time, in pure Python.
+# - prior = previous reconstructed scanline (uint8 array).
+def _unfilter_bytewise(data, filterTypes, prior, bpp):
+    (lineCount, rowBytes) = data.shape
+    prior = bytearray(prior.tobytes())
+    lines = []
+    for r in range(0, lineCount):
+        line = bytearray(data[r].tobytes())
+        filterType = filterTypes[r]
+        if filterType == FILTER_SUB:
+            for i in range(bpp, rowBytes):
+                line[i] = (line[i] + line[i-bpp]) & 0xFF
+        elif filterType == FILTER_UP:
+            for i in range(0, rowBytes):
+                line[i] = (line[i] + prior[i]) & 0xFF
+        elif filterType == FILTER_AVERAGE:
+            for i in range(0, bpp):
+                line[i] = (line[i] + (prior[i] >> 1)) & 0xFF
+            for i in range(bpp, rowBytes):
+                line[i] = (line[i] + ((line[i-bpp] + prior[i]) >> 1)) & 0xFF
+        elif filterType == FILTER_PAETH:
+            for i in range(0, bpp):
+                line[i] = (line[i] + prior[i]) & 0xFF # a = c = 0 => predictor is b
+            for i in range(bpp, rowBytes):
+                a = line[i-bpp]
+                b = prior[i]
+                c = prior[i-bpp]
+                pa = abs(b - c)
+                pb = abs(a - c)
+                pc = abs(a + b - c - c)
+                if pa <= pb and pa <= pc:
+                    line[i] = (line[i] + a) & 0xFF
+                elif pb <= pc:
+                    line[i] = (line[i] + b) & 0xFF
+                else:
+                    line[i] = (line[i] + c) & 0xFF
+        lines.append(line)
+        prior = line
+    return np.frombuffer(b"".join(lines), dtype=np.uint8).reshape(lineCount, rowBytes)
+
+# - un-filter scanlines of any filter types one anti-diagonal at a time.
+# - pixel (r, c) is stored at skewed[r+c+2, r+1], so that diagonal d is the row
+#   skewed[d+2]; row -1 holds prior, and column -1 stays 0.
+def _unfilter_wavefront(data, filterTypes, prior, bpp):
+    (lineCount, rowBytes) = data.shape
+    pixelCount = rowBytes // bpp
+
+    filtered = np.zeros((lineCount + pixelCount, lineCount, bpp), dtype=np.int16)
+    skewed = np.zeros((lineCount + pixelCount + 1, lineCount + 1, bpp), dtype=np.int16)
+    pixels = data.reshape(lineCount, pixelCount, bpp)
+    for r in range(0, lineCount):
+        filtered[r : r+pixelCount, r] = pixels[r]
+    skewed[1 : pixelCount+1, 0] = prior.reshape(pixelCount, bpp)
+    presentTypes = set(filterTypes)     # only the predictors of these are computed
+    filterTypes = np.asarray(filterTypes)[:, None]
+    (isSub, isUp, isAverage, isPaeth) = [filterTypes == filterType for filterType in (FILTER_SUB, FILTER_UP, FILTER_AVERAGE, FILTER_PAETH)]
+
+    for d in range(0, lineCount + pixelCount - 1):
+        r0 = max(0, d - pixelCount + 1)
+        r1 = min(lineCount, d + 1)
+        a = skewed[d+1, r0+1 : r1+1]
+        b = skewed[d+1, r0 : r1]
+        c = skewed[d, r0 : r1]
+
+        predictor = 0   # None
+        if FILTER_SUB in presentTypes:
+            predictor = _select_predictor(presentTypes, isSub[r0 : r1], a, predictor)
+        if FILTER_UP in presentTypes:
+            predictor = _select_predictor(presentTypes, isUp[r0 : r1], b, predictor)
+        if FILTER_AVERAGE in presentTypes:
+            predictor = _select_predictor(presentTypes, isAverage[r0 : r1], (a + b) >> 1, predictor)
+        if FILTER_PAETH in presentTypes:
+            pa = np.abs(b - c)
+            pb = np.abs(a - c)
+            pc = np.abs(a + b - c - c)
+            paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+            predictor = _select_predictor(presentTypes, isPaeth[r0 : r1], paeth, predictor)
+        skewed[d+2, r0+1 : r1+1] = (filtered[d, r0 : r1] + predictor) & 0xFF
+
+    unfiltered = np.empty((lineCount, pixelCount, bpp), dtype=np.uint8)
+    for r in range(0, lineCount):
+        unfiltered[r] = skewed[r+2 : r+2+pixelCount, r+1]
+    return unfiltered.reshape(lineCount, rowBytes)
+
+# predictor of the rows in mask, other rows keep predictor (no selection when all rows have one filter type)
+def _select_predictor(presentTypes, mask, value, predictor):
+    return (value) if (len(presentTypes) == 1) else (np.where(mask, value, predictor))
+
+# - un-filter a 2-D array of filtered scanlines (column 0 = filter type).
+# - prior = reconstructed scanline before the first one (None => all 0).
+@timed_stage('unfilter')
+def unfilter_scanlines(filtered, bpp, prior=None):
+    filterTypes = filtered[:, 0].tolist()
+    data = filtered[:, 1:]
+    (lineCount, rowBytes) = data.shape
+    unfiltered = np.empty_like(data)
+    prior = (np.zeros(rowBytes, dtype=np.uint8)) if (prior is None) else (prior)
+
+    if lineCount > 0 and max(filterTypes) > FILTER_PAETH:
+        raise ValueError(max(filterTypes))
+
+    for bandStart in range(0, lineCount, UNFILTER_BAND_SIZE):
+        bandEnd = min(lineCount, bandStart + UNFILTER_BAND_SIZE)
+        bandTypes = filterTypes[bandStart:bandEnd]
+
+        # rows first...last-1 need the recurrence; the rows around them are one vector operation each
+        recurrentRows = [r for (r, filterType) in enumerate(bandTypes, bandStart) if filterType == FILTER_AVERAGE or filterType == FILTER_PAETH]
+        (first, last) = ((recurrentRows[0], recurrentRows[-1] + 1)) if (recurrentRows) else ((bandEnd, bandEnd))
+
+        for r in range(bandStart, first):
+            unfiltered[r] = unfilter_scanline(filterTypes[r], data[r], prior, bpp)
+            prior = unfiltered[r]
+        if first < last:
+            runLength = last - first
+            if runLength * rowBytes > WAVEFRONT_COST * (runLength + rowBytes // bpp):
+                unfiltered[first:last] = _unfilter_wavefront(data[first:last], filterTypes[first:last], prior, bpp)
+            else:
+                unfiltered[first:last] = _unfilter_bytewise(data[first:last], filterTypes[first:last], prior, bpp)
+            prior = unfiltered[last-1]
+        for r in range(last, bandEnd):
+            unfiltered[r] = unfilter_scanline(filterTypes[r], data[r], prior, bpp)
+            prior = unfiltered[r]
+
+    return unfiltered
+
+# - un-filter streamed scanlines (bytearrays, as from iter_filtered_scanlines) in bands
+#   of bandSize rows; yields each reconstructed scanline as a 1-D uint8 array.
+# - skip = number of scanlines at the start not to yield (see _unfilter_skipped_scanlines()).
+@timed_stage('unfilter')
+def iter_unfiltered_scanlines(filteredScanlines, bpp, bandSize=UNFILTER_BAND_SIZE, skip=0):
+    filteredScanlines = iter(filteredScanlines)
+    prior = _unfilter_skipped_scanlines(itertools.islice(filteredScanlines, skip), bpp, bandSize)
+    band = []
+    for filteredScanline in itertools.chain(filteredScanlines, [None]):
+        if filteredScanline is not None:
+            band.append(filteredScanline)
+        if len(band) == bandSize or (filteredScanline is None and len(band) > 0):
+            filtered = np.frombuffer(b"".join(band), dtype=np.uint8).reshape(len(band), -1)
+            unfiltered = unfilter_scanlines(filtered, bpp, prior)
+            band = []
+            prior = unfiltered[-1]
+            for scanline in unfiltered:
+                yield scanline
+
+# - the scanline after the skipped ones only needs the last skipped scanline as its
+#   prior, and a scanline filtered with None or Sub does not depend on the ones
+#   above it; so only the scanlines from the last None / Sub one on are un-filtered.
+# - returns the last skipped scanline reconstructed, or None if nothing is skipped.
+def _unfilter_skipped_scanlines(filteredScanlines, bpp, bandSize=UNFILTER_BAND_SIZE):
+    prior = None
+    band = []
+    for filteredScanline in filteredScanlines:
+        if filteredScanline[0] == FILTER_NONE or filteredScanline[0] == FILTER_SUB:
+            prior = None
+            band = []
+        band.append(filteredScanline)
+        if len(band) == bandSize:
+            filtered = np.frombuffer(b"".join(band), dtype=np.uint8).reshape(len(band), -1)
+            prior = unfilter_scanlines(filtered, bpp, prior)[-1]
+            band = []
+
+    if len(band) > 0:
+        filtered = np.frombuffer(b"".join(band), dtype=np.uint8).reshape(len(band), -1)
+        prior = unfilter_scanlines(filtered, bpp, prior)[-1]
+    return prior
 
-# verify PNG Datastream critique chunks is not None
-# PS: PLTE is optional so no checking for that
-assert (not (pngDatastream.get_idhr_chunk() is None)), "Is None!!"
-assert (not (pngDatastream.get_idat_chunk() is None)), "Is None!!"
-assert (not (pngDatastream.get_iend_chunk() is None)), "Is None!!"
+# ---------------------------------------------------------------------------------
+# F2. Deserialization
+#
+# - turns reconstructed scanlines (bytes) into samples, shape (..., width, samples
+#   per pixel), without looking at any byte on its own:
+#   - 16 bits: a big-endian uint16 view of the same buffer (no copy).
+#   - 8 bits: the bytes are the samples.
+#   - 1 bit: np.unpackbits.
+#   - 2/4 bits: every byte is shifted by each sample offset at once and masked.
+#   Padding bits at the end of a row are cut off.
+# - the samples written to the PPM are a strided slice without alpha (every 2nd
+#   or 4th sample is skipped), or a palette lookup for colour type 3.
+# - the palette lookup table is padded to 256 entries, so the whole index array is
+#   expanded by a single np.take, and an index past the end of PLTE maps to black.
+# ---------------------------------------------------------------------------------
+SUB_BYTE_SHIFTS = {                                     # bitDepth => shift of each sample in a byte (left to right)
+    2: np.array([6, 4, 2, 0], dtype=np.uint8),
+    4: np.array([4, 0], dtype=np.uint8)
+}
+
+# scanlines = array of reconstructed scanlines, shape (..., bytes per row)
+@timed_stage('deserialize')
+def deserialize_scanlines(scanlines, width, colourType, bitDepth):
+    samplesPerPixel = SAMPLES_PER_PIXEL[colourType]
+    leadingShape = scanlines.shape[:-1]
+
+    if bitDepth == 16:
+        samples = np.ascontiguousarray(scanlines).view('>u2')
+    elif bitDepth == 8:
+        samples = scanlines
+    elif bitDepth == 1:
+        samples = np.unpackbits(scanlines, axis=-1, count=width * samplesPerPixel)
+    else:
+        mask = (1 << bitDepth) - 1
+        samples = (scanlines[..., None] >> SUB_BYTE_SHIFTS[bitDepth]) & mask
+        samples = samples.reshape(leadingShape + (-1,))[..., 0 : width * samplesPerPixel]
+
+    return samples.reshape(leadingShape + (width, samplesPerPixel))
+
+# number of channels written to the PPM: 1 for greyscale (P5/P2), 3 for colour (P6/P3)
+def get_output_channels(colourType):
+    return (1) if (colourType == 0 or colourType == 4) else (3)
+
+# largest sample value written to the PPM (palette entries are always 8 bits)
+def get_max_pixel_value(colourType, bitDepth):
+    return (255) if (colourType == 3) else ((1 << bitDepth) - 1) # e.g. 0...255 = (1...256) - 1 = (2**8)-1 = (1<<8)-1
+
+# - PLTE (and tRNS) => lookup table, shape (256, 3), or (256, 4) when alpha is True.
+# - entries without a tRNS value are opaque (alpha = 255).
+def build_palette(plteChunk, trnsChunk=None, alpha=False):
+    if plteChunk is None:
+        raise ValueError("Missing PLTE chunk")
+
+    entries = plteChunk.get_data()
+    palette = np.zeros((256, 4 if alpha else 3), dtype=np.uint8)
+    palette[0 : len(entries), 0:3] = entries
+    if alpha:
+        palette[:, 3] = 255
+        if trnsChunk is not None:
+            alphas = trnsChunk.get_data()[0 : len(entries)]
+            palette[0 : len(alphas), 3] = alphas
+    return palette
+
+# palette indices, any shape => colours, shape (..., 3) or (..., 4)
+def expand_palette(indices, palette):
+    return np.take(palette, indices, axis=0)
+
+# samples => samples written to the PPM; alpha is dropped, palette indices are looked up
+@timed_stage('write')
+def get_output_samples(samples, colourType, palette=None):
+    if colourType == 3:
+        return expand_palette(samples[..., 0], palette)
+    else:
+        return samples[..., 0 : get_output_channels(colourType)]
 
-# verify chunk data in PNG Datastream critique chunks is not None
-# PS: PLTE is optional so no checking for that
-assert (not (pngDatastream.get_idhr_chunk().get_data() is None)), "Is None!!"
-for idatChunk in pngDatastream.get_idat_chunk():
-    assert (not (idatChunk.get_data() is None)), "Is None!!"
-assert (not (pngDatastream.get_iend_chunk() is None)), "Is None!!"
+# ---------------------------------------------------------------------------------
+# F3. Un-interlacing (Adam7)
+#
+# - Adam7 splits the image into 7 passes; pass p holds the pixels at
+#   (y0 + i*dy, x0 + j*dx). Every pass is a small image of its own: its scanlines
+#   are filtered separately (the prior scanline restarts at 0), and a pass with no
+#   pixels has no scanlines at all.
+# - a decoded pass is put in place with one strided slice assignment.
+# - after pass p, the decoded pixels form a regular grid (ADAM7_GRIDS[p]), so a
+#   preview is the grid repeated to fill each cell.
+# ---------------------------------------------------------------------------------
+ADAM7_PASSES = (            # (y0, x0, dy, dx) of each pass
+    (0, 0, 8, 8),
+    (0, 4, 8, 8),
+    (4, 0, 8, 4),
+    (0, 2, 4, 4),
+    (2, 0, 4, 2),
+    (0, 1, 2, 2),
+    (1, 0, 2, 1)
+)
+ADAM7_GRIDS = ((8, 8), (8, 4), (4, 4), (4, 2), (2, 2), (2, 1), (1, 1))    # (dy, dx) of the decoded pixels after each pass
+
+# (passWidth, passHeight) of each pass
+def get_adam7_pass_sizes(width, height):
+    return [
+        ((width - x0 + dx - 1) // dx, (height - y0 + dy - 1) // dy)
+        for (y0, x0, dy, dx) in ADAM7_PASSES
+    ]
+
+# lengths of all filtered scanlines of all passes, in order (for iter_filtered_scanlines)
+def get_adam7_scanline_lengths(width, height, bitsPerPixel):
+    return itertools.chain.from_iterable(
+        itertools.repeat(get_scanline_length(passWidth, bitsPerPixel), passHeight)
+        for (passWidth, passHeight) in get_adam7_pass_sizes(width, height)
+        if passWidth > 0 and passHeight > 0
+    )
+
+# sample type returned by deserialize_scanlines()
+def get_sample_dtype(bitDepth):
+    return np.dtype('>u2') if (bitDepth == 16) else np.dtype(np.uint8)
+
+# - un-filter and deserialize the passes one by one, from the filtered scanlines of
+#   all passes (e.g. iter_filtered_scanlines(..., get_adam7_scanline_lengths(...))).
+# - the scanlines of a pass are un-filtered in bands as they stream in (see
+#   iter_unfiltered_scanlines()), so memory grows with the size of the pass only.
+# - yields (passIdx, samples of the pass, shape (passHeight, passWidth, samples per pixel)).
+def iter_adam7_passes(filteredScanlines, width, height, colourType, bitDepth):
+    filteredScanlines = iter(filteredScanlines)
+    bitsPerPixel = get_bits_per_pixel(colourType, bitDepth)
+    filterUnit = get_filter_unit(bitsPerPixel)
+
+    for (passIdx, (passWidth, passHeight)) in enumerate(get_adam7_pass_sizes(width, height)):
+        if passWidth == 0 or passHeight == 0:
+            continue
+
+        unfiltered = np.empty((passHeight, get_scanline_length(passWidth, bitsPerPixel) - 1), dtype=np.uint8)
+        lines = itertools.islice(filteredScanlines, passHeight)
+        for (rowIdx, scanline) in enumerate(iter_unfiltered_scanlines(lines, filterUnit)):
+            unfiltered[rowIdx] = scanline
+        yield (passIdx, deserialize_scanlines(unfiltered, passWidth, colourType, bitDepth))
+
+# passes (as from iter_adam7_passes) => samples of the whole image, shape (height, width, samples per pixel)
+@timed_stage('deserialize')
+def deinterlace_adam7(passes, width, height, colourType, bitDepth):
+    image = np.zeros((height, width, SAMPLES_PER_PIXEL[colourType]), dtype=get_sample_dtype(bitDepth))
+    for (passIdx, samples) in passes:
+        (y0, x0, dy, dx) = ADAM7_PASSES[passIdx]
+        image[y0::dy, x0::dx] = samples
+    return image
+
+# - progressive mode: yields (passIdx, preview) after each pass, where preview is the
+#   whole image with every pixel not decoded yet copied from the decoded pixel
+#   above-left of it; the preview after the last pass is the final image.
+def iter_adam7_progressive(passes, width, height, colourType, bitDepth):
+    image = np.zeros((height, width, SAMPLES_PER_PIXEL[colourType]), dtype=get_sample_dtype(bitDepth))
+    for (passIdx, samples) in passes:
+        (y0, x0, dy, dx) = ADAM7_PASSES[passIdx]
+        image[y0::dy, x0::dx] = samples
+
+        (gridDy, gridDx) = ADAM7_GRIDS[passIdx]
+        preview = np.repeat(np.repeat(image[::gridDy, ::gridDx], gridDy, axis=0), gridDx, axis=1)
+        yield (passIdx, preview[0:height, 0:width])
+
+# ---------------------------------------------------------------------------------
+# G. PPM Output
+#
+# - binary P6 (RGB) / P5 (greyscale): the header is followed by the samples as
+#   raw bytes (2 bytes per sample, big-endian, when the max value > 255), so each
+#   row is written straight from its array buffer.
+# - plain-text P3 (RGB) / P2 (greyscale): the samples are formatted as decimal
+#   numbers, one line per row.
+# ---------------------------------------------------------------------------------
+PPM_TYPES = {(3, False): 'P6', (1, False): 'P5', (3, True): 'P3', (1, True): 'P2'}    # (channels, plain) => image type
+PPM_EXTENSIONS = {'P6': 'ppm', 'P5': 'pgm', 'P3': 'ppm', 'P2': 'pgm'}
+
+def get_ppm_type(channels, plain=False):
+    return PPM_TYPES[(channels, plain)]
+
+def format_ppm_header(imgType, width, height, maxPixelVal):
+    lineOne = imgType
+    lineTwo = " ".join([str(width), str(height)])
+    lineThree = str(maxPixelVal)
+    return ("\n".join([lineOne, lineTwo, lineThree]) + "\n").encode('ascii')
+
+# - out = binary file object; pixelRows = one array of samples per row, in order
+#   (shape (width,) or (width, channels)).
+@timed_stage('write')
+def write_ppm(out, imgType, width, height, maxPixelVal, pixelRows):
+    out.write(format_ppm_header(imgType, width, height, maxPixelVal))
+
+    if imgType == 'P6' or imgType == 'P5':
+        sampleType = np.dtype('>u2') if (maxPixelVal > 255) else np.dtype(np.uint8)
+        for row in pixelRows:
+            row = np.ascontiguousarray(row, dtype=sampleType)          # no copy when row is already contiguous
+            out.write(row)
+            add_count('pixelBytesWritten', row.nbytes)
+    else:
+        for row in pixelRows:
+            line = (" ".join(map(str, row.ravel().tolist())) + "\n").encode('ascii')
+            out.write(line)
+            add_count('pixelBytesWritten', len(line))
 
 # ---------------------------------------------------------------------------------
-# Step 2a : Derive Zlib Datastream
+# G2. PPM Input
+#
+# - reads P6/P5 (binary) and P3/P2 (plain) images, e.g. the ones written above.
+# - header: image type, width, height and max value, separated by whitespace,
+#   with '#' comments up to the end of the line; one whitespace byte follows the
+#   max value, then the samples.
 # ---------------------------------------------------------------------------------
-print("\n[*] Execute Step 2...") 
+PPM_CHANNELS = {'P6': 3, 'P5': 1, 'P3': 3, 'P2': 1}
+
+# data = whole PPM file (bytes) => (image type, width, height, max value, index of the first sample byte)
+def parse_ppm_header(data):
+    fields = []
+    idx = 0
+    while len(fields) < 4:
+        if idx >= len(data):
+            raise ValueError("Truncated PPM header")
+        if data[idx:idx+1].isspace():
+            idx += 1
+        elif data[idx:idx+1] == b"#":
+            idx = data.find(b"\n", idx)
+            idx = (len(data)) if (idx < 0) else (idx)
+        else:
+            endIdx = idx
+            while endIdx < len(data) and not data[endIdx:endIdx+1].isspace() and data[endIdx:endIdx+1] != b"#":
+                endIdx += 1
+            fields.append(data[idx:endIdx].decode('ascii'))
+            idx = endIdx
+
+    imgType = fields[0]
+    if imgType not in PPM_CHANNELS:
+        raise ValueError(imgType)
+    (width, height, maxPixelVal) = [int(field) for field in fields[1:4]]
+    if width <= 0 or height <= 0 or not (0 < maxPixelVal <= 65535):
+        raise ValueError("{0} {1} {2}".format(width, height, maxPixelVal))
+    return (imgType, width, height, maxPixelVal, idx + 1)
+
+# f = binary file object => (samples, shape (height, width, channels), max value)
+@timed_stage('parse')
+def read_ppm(f):
+    data = f.read()
+    (imgType, width, height, maxPixelVal, dataStartIdx) = parse_ppm_header(data)
+    sampleCount = width * height * PPM_CHANNELS[imgType]
+
+    if imgType == 'P6' or imgType == 'P5':
+        sampleType = np.dtype('>u2') if (maxPixelVal > 255) else np.dtype(np.uint8)
+        samples = np.frombuffer(data, dtype=sampleType, count=sampleCount, offset=dataStartIdx) \
+            if (len(data) - dataStartIdx >= sampleCount * sampleType.itemsize) else (None)
+    else:
+        samples = np.array(data[dataStartIdx:].split()[0:sampleCount], dtype=np.uint16)
+        samples = (samples) if (len(samples) == sampleCount) else (None)
+
+    if samples is None:
+        raise ValueError("Not enough image data: {0}x{1} {2}".format(width, height, imgType))
+    return (samples.reshape(height, width, PPM_CHANNELS[imgType]), maxPixelVal)
 
-idatChunks = pngDatastream.get_idat_chunk()
-idatChunkData = "".join([idatChunk.get_data() for idatChunk in idatChunks])     # concatenate all chunkData from IDAT chunks
+# ---------------------------------------------------------------------------------
+# H. Serialization and Filtering (Encoder)
+#
+# - the reverse of F2 and F: samples => scanline bytes => filtered scanlines.
+#   - 16 bits: big-endian bytes of each sample; 8 bits: the samples are the bytes.
+#   - 1 bit: np.packbits; 2/4 bits: the samples of each byte are shifted into
+#     place and added up. Rows are padded with 0 bits to a whole byte.
+# - filtering only looks at the original bytes (a, b and c are not filtered), so
+#   all five filters are computed for a whole band of rows at once, in int16.
+# - adaptive filtering: every row keeps the filter whose output has the smallest
+#   sum of absolute values, with the bytes taken as signed (-128...127). As the PNG
+#   specification recommends, palette images and bit depths below 8 are not
+#   filtered (None), since their bytes are not sample values.
+# - filterType forces one filter for every row instead, or a sequence of filters
+#   used in turn, row after row (e.g. to test decoders on mixed filter types).
+# ---------------------------------------------------------------------------------
+FILTER_BAND_BYTES = 1 << 20     # bytes of scanlines filtered together (5 filtered copies in int16 are held at once)
+
+# samples, shape (..., width, samples per pixel) => scanline bytes, shape (..., bytes per row), without filter type
+def serialize_samples(samples, colourType, bitDepth):
+    leadingShape = samples.shape[:-2]
+    samples = samples.reshape(leadingShape + (samples.shape[-2] * SAMPLES_PER_PIXEL[colourType],))
+
+    if bitDepth == 16:
+        return samples.astype('>u2').view(np.uint8)
+    elif bitDepth == 8:
+        return samples.astype(np.uint8, copy=False)
+    elif bitDepth == 1:
+        return np.packbits(samples.astype(np.uint8, copy=False), axis=-1)
+    else:
+        samplesPerByte = 8 // bitDepth
+        padded = np.zeros(leadingShape + (-(-samples.shape[-1] // samplesPerByte) * samplesPerByte,), dtype=np.uint8)
+        padded[..., 0 : samples.shape[-1]] = samples
+        padded = padded.reshape(leadingShape + (-1, samplesPerByte)) << SUB_BYTE_SHIFTS[bitDepth]
+        return padded.sum(axis=-1, dtype=np.uint8)
+
+# - scanlines = unfiltered scanline bytes, shape (rows, bytes per row); prior = the
+#   scanline before the first one (None = all 0).
+# - returns the filtered scanlines with their filter type byte, shape (rows, 1 + bytes per row)
+def filter_scanlines(scanlines, bpp, prior=None, filterType=None):
+    (rowCount, lineLength) = scanlines.shape
+    x = scanlines.astype(np.int16)
+
+    above = np.zeros_like(x)                            # b
+    above[1:] = x[:-1]
+    if prior is not None:
+        above[0] = prior
+    left = np.zeros_like(x)                             # a
+    left[:, bpp:] = x[:, :-bpp]
+    aboveLeft = np.zeros_like(x)                        # c
+    aboveLeft[:, bpp:] = above[:, :-bpp]
+
+    # Paeth predictor; p - a = b - c, p - b = a - c, p - c = a + b - 2c
+    pa = np.abs(above - aboveLeft)
+    pb = np.abs(left - aboveLeft)
+    pc = np.abs(left + above - aboveLeft - aboveLeft)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, above, aboveLeft))
+
+    predictions = np.stack([np.zeros_like(x), left, above, (left + above) >> 1, paeth])
+    filtered = (x - predictions) & 0xFF                 # shape (5, rows, bytes per row)
+
+    if filterType is None:
+        signed = filtered - ((filtered >> 7) << 8)      # 128...255 => -128...-1
+        filterTypes = np.argmin(np.abs(signed).sum(axis=-1), axis=0)
+    elif isinstance(filterType, (tuple, list)):     # in turn, from the first row
+        if len(filterType) == 0 or not set(filterType) <= {FILTER_NONE, FILTER_SUB, FILTER_UP, FILTER_AVERAGE, FILTER_PAETH}:
+            raise ValueError(filterType)
+        filterTypes = np.resize(np.asarray(filterType, dtype=np.intp), rowCount)
+    elif filterType in (FILTER_NONE, FILTER_SUB, FILTER_UP, FILTER_AVERAGE, FILTER_PAETH):
+        filterTypes = np.full(rowCount, filterType)
+    else:
+        raise ValueError(filterType)
+
+    result = np.empty((rowCount, 1 + lineLength), dtype=np.uint8)
+    result[:, 0] = filterTypes
+    result[:, 1:] = filtered[filterTypes, np.arange(rowCount)]
+    return result
+
+# - samples, shape (height, width, samples per pixel) => filtered scanlines of the
+#   whole image (of every Adam7 pass in turn, if interlaceMethod is 1).
+# - yields arrays of filtered scanlines, shape (rows, 1 + bytes per row), in order.
+@timed_stage('filter')
+def iter_filtered_bands(samples, colourType, bitDepth, interlaceMethod=0, filterType=None):
+    bitsPerPixel = get_bits_per_pixel(colourType, bitDepth)
+    filterUnit = get_filter_unit(bitsPerPixel)
+    if filterType is None and (colourType == 3 or bitDepth < 8):
+        filterType = FILTER_NONE
+
+    if interlaceMethod == 0:    # no interlace
+        images = [samples]
+    elif interlaceMethod == 1:  # Adam7 interlace; every pass is filtered as an image of its own
+        images = [samples[y0::dy, x0::dx] for (y0, x0, dy, dx) in ADAM7_PASSES]
+    else:
+        raise ValueError(interlaceMethod)
+
+    for image in images:
+        (imageHeight, imageWidth) = image.shape[0:2]
+        if imageHeight == 0 or imageWidth == 0:
+            continue
+
+        bandSize = max(1, FILTER_BAND_BYTES // get_scanline_length(imageWidth, bitsPerPixel))
+        prior = None
+        for startIdx in range(0, imageHeight, bandSize):
+            scanlines = serialize_samples(image[startIdx : startIdx+bandSize], colourType, bitDepth)
+            bandFilterType = filterType
+            if isinstance(filterType, (tuple, list)):   # carry on the sequence from the row the band starts at
+                offset = startIdx % len(filterType)
+                bandFilterType = tuple(filterType[offset:]) + tuple(filterType[:offset])
+            yield filter_scanlines(scanlines, filterUnit, prior, bandFilterType)
+            prior = scanlines[-1]
 
-# parse chunk data after concatenating.
-compressionMethod = idatChunkData[0:2]         # get zlib compression method 
-additionalFlags = idatChunkData[2:4]           # get additional flags
-compressedDataBlocks = idatChunkData[4:-8]     # get compressed data blocks
-checkValues = idatChunkData[-8:]               # get check value 
-assert (len(compressionMethod) == 2), "Wrong Length!!"
-assert (len(additionalFlags) == 2), "Wrong Length!!"
-assert (len(checkValues) == 8), "Wrong Length!!"
-assert (len(compressionMethod) + len(additionalFlags) + len(compressedDataBlocks) + len(checkValues) == len(idatChunkData)), "Inconsistent Length!!"
+# ---------------------------------------------------------------------------------
+# H2. Compression (Encoder)
+#
+# - the filtered image data is cut into bands of COMPRESS_BAND_SIZE bytes, which
+#   are compressed at the same time by a pool of threads (zlib releases the GIL
+#   while it compresses).
+# - every band is a raw deflate stream primed with the 32K of data before it as
+#   its dictionary, so matches still reach back across band boundaries. A band
+#   ends with Z_SYNC_FLUSH (byte-aligned, not the final block), and the last one
+#   with Z_FINISH, so the bands put together are one deflate stream.
+# - the zlib header and the ADLER-32 of the whole data are added around it.
+# ---------------------------------------------------------------------------------
+COMPRESS_BAND_SIZE = 1 << 20
+COMPRESS_LEVEL = 6
+
+# zlib header (CMF, FLG) as zlib writes it for the compression level
+def format_zlib_header(level):
+    cmf = 0x78                  # CM = 8 (deflate), CINFO = 7 (32K window)
+    if level == 0 or level == 1:
+        flevel = 0              # fastest
+    elif 2 <= level <= 5:
+        flevel = 1              # fast
+    elif level == 6 or level == -1:
+        flevel = 2              # default
+    else:
+        flevel = 3              # maximum compression
+    flg = flevel << 6
+    flg += (31 - ((cmf << 8) + flg) % 31) % 31  # FCHECK: CMF * 256 + FLG must be a multiple of 31
+    return bytes([cmf, flg])
+
+def _compress_band(band, dictionary, level, isLast):
+    if len(dictionary) > 0:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(band) + compressor.flush((zlib.Z_FINISH) if (isLast) else (zlib.Z_SYNC_FLUSH))
+
+# - data = filtered image data (bytes-like) => zlib datastream (bytes)
+# - workers = number of threads (None = as many as concurrent.futures picks)
+@timed_stage('compress')
+def compress_parallel(data, level=COMPRESS_LEVEL, workers=None, bandSize=COMPRESS_BAND_SIZE):
+    view = memoryview(data).cast('B')
+    bandStarts = range(0, max(1, len(view)), bandSize)
+    bands = [view[startIdx : startIdx+bandSize] for startIdx in bandStarts]
+    dictionaries = [view[max(0, startIdx-WINDOW_SIZE) : startIdx] for startIdx in bandStarts]
+    isLast = [startIdx + bandSize >= len(view) for startIdx in bandStarts]
+    levels = [level] * len(bands)
+
+    if len(bands) == 1 or workers == 1:
+        pieces = list(map(_compress_band, bands, dictionaries, levels, isLast))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pieces = list(executor.map(_compress_band, bands, dictionaries, levels, isLast))
 
-# create new empty ZlibDatastream
-zlibDatastream = ZlibDatastream()
-assert (zlibDatastream.get_compression_details() is None), "Wrong Value!!"
-assert (zlibDatastream.get_flags() is None), "Wrong Value!!"
-assert (zlibDatastream.get_compressed_data() is None), "Wrong Value!!"
-assert (zlibDatastream.get_check_value() is None), "Wrong Value!!"
+    zlibData = format_zlib_header(level) + b"".join(pieces) + struct.pack(">I", zlib.adler32(view))
+    add_count('filteredBytesIn', len(view))
+    add_count('compressedBytesOut', len(zlibData))
+    return zlibData
 
-# store information into ZlibDatastream object
-zlibDatastream.set_compression_details(compressionMethod)
-zlibDatastream.set_flags(additionalFlags)
-zlibDatastream.set_compressed_data(compressedDataBlocks)
-zlibDatastream.set_check_value(checkValues)
-assert (zlibDatastream.get_compression_details() == compressionMethod), "Wrong Value!!"
-assert (zlibDatastream.get_flags() == additionalFlags), "Wrong Value!!"
-assert (zlibDatastream.get_compressed_data() == compressedDataBlocks), "Wrong Value!!"
-assert (zlibDatastream.get_check_value() == checkValues), "Wrong Value!!"
+# ---------------------------------------------------------------------------------
+# H3. PNG Output
+#
+# - chunks are made by Chunk.create() as in the reader, and hold the same data
+#   (IHDR dictionary, PLTE / tRNS arrays, IDAT bytes); pack_data() turns it back
+#   into the data field, and the CRC is computed over type and data field.
+# - the zlib datastream is split into IDAT chunks of at most idatSize bytes.
+# ---------------------------------------------------------------------------------
+IDAT_CHUNK_SIZE = 1 << 16
+
+# new Chunk of corresponding type holding data, with its length and CRC
+def build_chunk(chunkType, chunkData):
+    chunk = Chunk.create(chunkType)
+    packed = chunk.pack_data(chunkData)
+    chunk.set_length(len(packed))
+    chunk.set_type(chunkType)
+    chunk.set_data(chunkData)
+    chunk.set_crc(zlib.crc32(packed, zlib.crc32(chunkType)))
+    return chunk
+
+def write_chunk(out, chunk):
+    out.write(struct.pack(">I4s", chunk.get_length(), chunk.get_type()))
+    out.write(chunk.pack_data(chunk.get_data()))
+    out.write(struct.pack(">I", chunk.get_crc()))
+
+# out = binary file object; chunks are written in the order IHDR, PLTE, tRNS, IDAT..., IEND
+@timed_stage('write')
+def write_png_datastream(out, pngDatastream):
+    out.write(pngDatastream.get_signature())
+    chunks = (
+        [pngDatastream.get_idhr_chunk(), pngDatastream.get_plte_chunk(), pngDatastream.get_trns_chunk()]
+        + (pngDatastream.get_idat_chunk() or [])
+        + [pngDatastream.get_iend_chunk()]
+    )
+    for chunk in chunks:
+        if chunk is not None:
+            write_chunk(out, chunk)
 
-print("[*] compression method:                  {0}".format(zlibDatastream.get_compression_details()))
-print("[*] additional flags:                    {0}".format(zlibDatastream.get_flags()))
-print("[*] length of compressed data blocks:    {0}".format(len(zlibDatastream.get_compressed_data())))
-print("[*] BFINAL (is last block?):             {0}".format(get_bit(zlibDatastream.get_compressed_data()[1], 0))) # bit 0 of byte 0 (i.e. bit 0 of right hex)
-print("[*] BTYPE - bit 2:                       {0}".format(get_bit(zlibDatastream.get_compressed_data()[1], 1))) # bit 1 of byte 0 (i.e. bit 1 of right hex)
-print("[*] BTYPE - bit 3:                       {0}".format(get_bit(zlibDatastream.get_compressed_data()[1], 2))) # bit 2 of byte 0 (i.e. bit 2 of right hex)
-print("[*] check value:                         {0}".format(zlibDatastream.get_check_value()))
-print("[*] IDHR Chunk Data:                     {0}".format(pngDatastream.get_idhr_chunk().get_data()))
+# =================================================================================
+# Conversion
+# =================================================================================
 
 # ---------------------------------------------------------------------------------
-# Step 2b : Decompress Zlib Datastream
+# Step 1 : Read PNG image file, and store the chunks before the image data
+#
+# - chunks are read one at a time; IDAT data is streamed into Step 2 instead of
+#   being stored, so memory does not grow with the file size.
+# - returns an iterator over the data of all IDAT chunks; the chunks after the
+#   image data (i.e. IEND) are stored once it is exhausted.
+# - verify = check the CRC of every chunk as it is read.
 # ---------------------------------------------------------------------------------
-hexZlibDatastream = "".join([zlibDatastream.get_compression_details(),
-                                zlibDatastream.get_flags(),
-                                zlibDatastream.get_compressed_data(),
-                                zlibDatastream.get_check_value()])
+def read_png_header(f, pngDatastream, verify=True, stats=None):
+    pngDatastream.set_signature(PNG_SIGNATURE)
+
+    chunkFields = iter_file_chunk_fields(f)
+    if verify:
+        chunkFields = iter_verified_chunk_fields(chunkFields, stats)
 
-bytesZlibDatastream = bytes.fromhex(hexZlibDatastream) # hex string to bytes for decompression.
+    idatData = iter_idat_data(chunkFields, pngDatastream)
+    firstIdatData = next(idatData, None)    # IHDR (and PLTE) must appear before the first IDAT
 
-bytesFilteredScanlines = zlib.decompress(bytesZlibDatastream, 0)
+    # verify PNG Datastream critique chunks is not None
+    # PS: PLTE is optional so no checking for that; IEND is checked after Step 4
+    assert (not (pngDatastream.get_idhr_chunk() is None)), "Is None!!"
+    assert (not (pngDatastream.get_idhr_chunk().get_data() is None)), "Is None!!"
+    assert (not (firstIdatData is None)), "Is None!!"
 
-# hexStrFilteredScanlines = bytesFilteredScanlines.hex().upper() # for reconstruction in the future.
+    return itertools.chain([firstIdatData], idatData)
 
 # ---------------------------------------------------------------------------------
+# Step 2 : Decompress Zlib Datastream
+#
+# - IDAT data is inflated incrementally, and regrouped into filtered scanlines
+#   which are emitted row by row.
+#
 # Step 3a : Derive Filtered Scanlines
+#
+# - reconstruct (un-filter) the scanlines; rows come out as uint8 arrays without
+#   the filter type byte.
+#
+# Step 3b : Deserialize Scanlines
+#
+# - one array of samples per row, shape (width, samples per pixel).
+#
+# Step 3c : Un-interlace (Adam7)
+#
+# - interlaced images: steps 3a and 3b are done for each pass, then all passes
+#   are put together into the whole image.
+#
+# Rows start...stop-1 only (start = 0, stop = None => all rows)
+#
+# - no interlace: the image data is inflated only up to row stop - 1, and the
+#   rows before start are un-filtered only as far as row start depends on them;
+#   the rest of the IDAT data is not read, and ADLER-32 is not checked.
+# - Adam7: every pass covers the whole image, so it is decoded in full.
 # ---------------------------------------------------------------------------------
+def iter_sample_rows(idatData, ihdrData, zlibDatastream=None, verify=True, stats=None, inflateBackend='zlib', inflateStats=None, start=0, stop=None):
+    width = ihdrData.width
+    height = ihdrData.height
+    colourType = ihdrData.colourType
+    bitDepth = ihdrData.bitDepth
+    interlaceMethod = ihdrData.interlaceMethod
+    bitsPerPixel = get_bits_per_pixel(colourType, bitDepth)
+
+    stop = (height) if (stop is None) else (min(stop, height))
+    if interlaceMethod == 0:    # no interlace
+        lineLengths = itertools.repeat(get_scanline_length(width, bitsPerPixel), stop)
+    elif interlaceMethod == 1:  # Adam7 interlace
+        lineLengths = get_adam7_scanline_lengths(width, height, bitsPerPixel)
+    else:
+        raise ValueError(interlaceMethod)
+
+    inflatedPieces = iter_inflate(idatData, zlibDatastream, verify=verify, stats=stats, inflateBackend=inflateBackend, inflateStats=inflateStats)
+    filteredScanlines = iter_filtered_scanlines(inflatedPieces, lineLengths)
 
+    if interlaceMethod == 0:
+        for scanline in iter_unfiltered_scanlines(filteredScanlines, get_filter_unit(bitsPerPixel), skip=start):
+            yield deserialize_scanlines(scanline, width, colourType, bitDepth)
+    else:
+        passes = iter_adam7_passes(filteredScanlines, width, height, colourType, bitDepth)
+        for samples in deinterlace_adam7(passes, width, height, colourType, bitDepth)[start:stop]:
+            yield samples
+
+    # read the rest of the zlib datastream (checks that it is complete)
+    if interlaceMethod == 1 or stop == height:
+        for inflated in inflatedPieces:
+            pass
+
+# - progressive mode: yields (passIdx, preview) after each Adam7 pass, as
+#   iter_adam7_progressive(); the last preview is the whole image.
+# - an image without interlace has no passes: it is yielded once, as (6, whole image).
+def iter_previews(idatData, ihdrData, verify=True, stats=None, inflateBackend='zlib'):
+    width = ihdrData.width
+    height = ihdrData.height
+    colourType = ihdrData.colourType
+    bitDepth = ihdrData.bitDepth
+
+    if ihdrData.interlaceMethod != 1:
+        samples = np.empty((height, width, SAMPLES_PER_PIXEL[colourType]), dtype=get_sample_dtype(bitDepth))
+        for (rowIdx, row) in enumerate(iter_sample_rows(idatData, ihdrData, verify=verify, stats=stats, inflateBackend=inflateBackend)):
+            samples[rowIdx] = row
+        yield (len(ADAM7_PASSES) - 1, samples)
+        return
+
+    lineLengths = get_adam7_scanline_lengths(width, height, get_bits_per_pixel(colourType, bitDepth))
+    inflatedPieces = iter_inflate(idatData, verify=verify, stats=stats, inflateBackend=inflateBackend)
+    passes = iter_adam7_passes(iter_filtered_scanlines(inflatedPieces, lineLengths), width, height, colourType, bitDepth)
+    yield from iter_adam7_progressive(passes, width, height, colourType, bitDepth)
+
+    # read the rest of the zlib datastream (checks that it is complete)
+    for inflated in inflatedPieces:
+        pass
 
 # ---------------------------------------------------------------------------------
 # Step 4 : Format and Output PPM
+#
+# - rows are written as they are decoded; binary P6/P5 by default, P3/P2 if plain.
+# - the output is written next to the input, or into outDir.
 # ---------------------------------------------------------------------------------
-image = ""
+def get_output_file_name(inFileName, outExtName, outDir=None):
+    (fileName, extName) = os.path.splitext(inFileName)
+    if outDir is not None:
+        fileName = os.path.join(outDir, os.path.basename(fileName))
+    return ".".join([fileName, outExtName])
+
+# - convert one PNG image into a PPM/PGM image; returns the output file name.
+# - verify = check CRC-32 of every chunk and ADLER-32 of the image data; the time
+#   spent on it is added to stats (IntegrityStats) if given.
+# - inflateBackend = 'zlib' or 'native' (see iter_inflate()).
+# - cache = DecodedImageCache, or None; on a hit, Step 2 and 3 are skipped.
+def convert(inFileName, outDir=None, plain=False, verify=True, stats=None, inflateBackend='zlib', cache=None):
+    logger.info("Execute Step 1: %s", inFileName)
+    pngDatastream = PngDatastream()
+    zlibDatastream = ZlibDatastream()
+    inflateStats = InflateStats()
+
+    with open(inFileName, "rb") as f:
+        idatData = read_png_header(f, pngDatastream, verify, stats)
+        ihdrData = pngDatastream.get_idhr_chunk().get_data()
+        colourType = ihdrData.colourType
+        bitDepth = ihdrData.bitDepth
+
+        cachedSamples = None
+        if cache is not None:
+            imageKey = get_image_key(ihdrData, idatData)
+            cachedSamples = cache.get(imageKey)
+            idatData = (reread_idat_data(f)) if (cachedSamples is None) else (idatData)
+
+        if cachedSamples is not None:
+            logger.info("Cache hit, skip Step 2 and 3")
+            sampleRows = iter(cachedSamples)
+        else:
+            logger.info("Execute Step 2")
+            sampleRows = iter_sample_rows(idatData, ihdrData, zlibDatastream, verify, stats, inflateBackend, inflateStats)
+            if cache is not None:
+                sampleShape = (ihdrData.height, ihdrData.width, SAMPLES_PER_PIXEL[colourType])
+                sampleRows = cache.iter_store_rows(imageKey, sampleShape, get_sample_dtype(bitDepth), sampleRows)
+
+        # alpha dropped / palette looked up for output
+        palette = None
+        if colourType == 3:
+            palette = build_palette(pngDatastream.get_plte_chunk(), pngDatastream.get_trns_chunk())
+
+        pixelRows = (get_output_samples(samples, colourType, palette) for samples in sampleRows)
+
+        imgType = get_ppm_type(get_output_channels(colourType), plain)
+        maxPixelVal = get_max_pixel_value(colourType, bitDepth)
+        outFileName = get_output_file_name(inFileName, PPM_EXTENSIONS[imgType], outDir)
+
+        with open(outFileName, 'wb') as out:
+            write_ppm(out, imgType, ihdrData.width, ihdrData.height, maxPixelVal, pixelRows)
+
+        # read the chunks after the image data (i.e. IEND)
+        for idatChunkData in idatData:
+            pass
+
+    assert (not (pngDatastream.get_iend_chunk() is None)), "Is None!!"
+
+    if cachedSamples is None:
+        logger.info("compression method:                  %s", zlibDatastream.get_compression_details().hex().upper())
+        logger.info("additional flags:                    %s", zlibDatastream.get_flags().hex().upper())
+        logger.info("check value:                         %s", zlibDatastream.get_check_value().hex().upper())
+    logger.info("IDHR Chunk Data:                     %s", ihdrData)
+    if inflateBackend == 'native' and cachedSamples is None:
+        logger.info("deflate blocks:                      %s", inflateStats.format())
+        for (blockIdx, block) in enumerate(inflateStats.get_blocks()):
+            logger.debug("  block %d: %s, %d literals, %d matches, %d bits -> %d bytes",
+                blockIdx, BTYPE_NAMES[block['type']], block['literals'], block['matches'], block['inputBits'], block['outputBytes']
+            )
+
+    return outFileName
+
+# =================================================================================
+# PNG Image
+#
+# - PngImage.open() reads only the signature and IHDR, so the size and colour type
+#   are known without touching the image data.
+# - the image data is decompressed, un-filtered and deserialized on the first
+#   access to the samples, and kept from then on.
+# =================================================================================
+class PngImage:
+
+    def __init__(self, source, pngDatastream, verify=True, inflateBackend='zlib', cache=None):
+        self._source = source                   # file path, or bytes-like PNG data
+        self._pngDatastream = pngDatastream     # only IHDR until the image is decoded
+        self._verify = verify                   # check CRC-32 / ADLER-32 while decoding
+        self._inflateBackend = inflateBackend   # 'zlib' or 'native'
+        self._cache = cache                     # DecodedImageCache, or None
+        self._samples = None                    # ndarray (height, width, samples per pixel); None until decoded
+        pass
+
+    # source = file path, or bytes-like object holding a PNG datastream
+    @classmethod
+    def open(cls, source, verify=True, inflateBackend='zlib', cache=None):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            chunkFields = iter_chunk_fields(source)
+            chunkFields = (iter_verified_chunk_fields(chunkFields)) if (verify) else (chunkFields)
+            (chunkStartIdx, length, chunkType, chunkData, crc) = next(chunkFields, (None, None, None, None, None))
+        else:
+            with open(source, "rb") as f:
+                chunkFields = iter_file_chunk_fields(f)
+                chunkFields = (iter_verified_chunk_fields(chunkFields)) if (verify) else (chunkFields)
+                (chunkStartIdx, length, chunkType, chunkData, crc) = next(chunkFields, (None, None, None, None, None))
+
+        if chunkType != b'IHDR': # IHDR must be the first chunk
+            raise ValueError(chunkType)
+
+        pngDatastream = PngDatastream()
+        pngDatastream.set_signature(PNG_SIGNATURE)
+        pngDatastream.set_chunk(create_chunk(length, chunkType, chunkData, crc))
+        get_bits_per_pixel(pngDatastream.get_idhr_chunk().get_data().colourType, pngDatastream.get_idhr_chunk().get_data().bitDepth) # raises if invalid
+        return cls(source, pngDatastream, verify, inflateBackend, cache)
+
+    # --- accessors ---
+    def get_width(self):
+        return self._pngDatastream.get_idhr_chunk().get_data().width
+
+    def get_height(self):
+        return self._pngDatastream.get_idhr_chunk().get_data().height
+
+    def get_bit_depth(self):
+        return self._pngDatastream.get_idhr_chunk().get_data().bitDepth
+
+    def get_colour_type(self):
+        return self._pngDatastream.get_idhr_chunk().get_data().colourType
+
+    def get_interlace_method(self):
+        return self._pngDatastream.get_idhr_chunk().get_data().interlaceMethod
+
+    def get_png_datastream(self):
+        return self._pngDatastream
+
+    def is_decoded(self):
+        return self._samples is not None
+
+    # - samples as deserialized: big-endian uint16 for bit depth 16, palette indices
+    #   for colour type 3; decodes the image on first call.
+    def get_samples(self):
+        if self._samples is None:
+            self._decode()
+        return self._samples
+
+    # - rows start...stop-1 of the samples (negative / out of range values as in a slice),
+    #   shape (rows, width, samples per pixel).
+    # - unless the whole image is decoded already, only the image data up to row
+    #   stop - 1 is read and inflated (see iter_sample_rows()); nothing is kept.
+    def decode_rows(self, start, stop):
+        if self._samples is not None:
+            return self._samples[start:stop]
+
+        (start, stop, step) = slice(start, stop).indices(self.get_height())
+        if start >= stop:
+            return np.empty((0, self.get_width(), SAMPLES_PER_PIXEL[self.get_colour_type()]), dtype=get_sample_dtype(self.get_bit_depth()))
+        (pngDatastream, samples) = self._read_rows(start, stop)
+        self._pngDatastream = pngDatastream
+        return samples
+
+    # samples of the region left...right-1 x top...bottom-1; reads the rows as decode_rows()
+    def crop(self, left, top, right, bottom):
+        return self.decode_rows(top, bottom)[:, left:right]
+
+    # - progressive decoding: yields (passIdx, preview) as each Adam7 pass is decoded
+    #   (see iter_previews()), e.g. to show a low-resolution thumbnail early.
+    # - the last preview is the whole image, which is kept as the samples.
+    def iter_progressive(self):
+        if self._samples is not None:
+            yield (len(ADAM7_PASSES) - 1, self._samples)
+            return
+
+        pngDatastream = PngDatastream()
+        preview = None
+        with self._open_source() as f:
+            idatData = read_png_header(f, pngDatastream, self._verify)
+            previews = iter_previews(idatData, pngDatastream.get_idhr_chunk().get_data(), verify=self._verify, inflateBackend=self._inflateBackend)
+            for (passIdx, preview) in previews:
+                yield (passIdx, preview)
+
+            # read the chunks after the image data (i.e. IEND)
+            for idatChunkData in idatData:
+                pass
+
+        assert (not (pngDatastream.get_iend_chunk() is None)), "Is None!!"
+        self._pngDatastream = pngDatastream
+        self._samples = preview
+
+    # lookup table of colour type 3 (see build_palette()), or None; decodes the image on first call
+    def get_palette(self, alpha=False):
+        if self.get_colour_type() != 3:
+            return None
+        if self._pngDatastream.get_plte_chunk() is None:
+            self._read_header()     # PLTE / tRNS are read with the chunks before the image data
+        return build_palette(self._pngDatastream.get_plte_chunk(), self._pngDatastream.get_trns_chunk(), alpha)
+
+    # write the image as PPM/PGM; returns the image type written
+    def write_ppm(self, out, plain=False):
+        colourType = self.get_colour_type()
+        pixels = get_output_samples(self.get_samples(), colourType, self.get_palette())
+        imgType = get_ppm_type(get_output_channels(colourType), plain)
+        write_ppm(out, imgType, self.get_width(), self.get_height(), get_max_pixel_value(colourType, self.get_bit_depth()), pixels)
+        return imgType
+
+    def _open_source(self):
+        if isinstance(self._source, (bytes, bytearray, memoryview)):
+            return io.BytesIO(self._source)
+        else:
+            return open(self._source, "rb")
+
+    def _decode(self):
+        if self._cache is None:
+            (pngDatastream, samples) = self._read_rows(0, self.get_height())
+        else:
+            (pngDatastream, samples) = self._read_cached()
+        assert (not (pngDatastream.get_iend_chunk() is None)), "Is None!!"
+        self._pngDatastream = pngDatastream
+        self._samples = samples
+
+    # as _read_rows() for the whole image, through the cache; a hit is a read-only memory map
+    def _read_cached(self):
+        pngDatastream = PngDatastream()
+        with self._open_source() as f:
+            idatData = read_png_header(f, pngDatastream, self._verify)
+            ihdrData = pngDatastream.get_idhr_chunk().get_data()
+            imageKey = get_image_key(ihdrData, idatData)
+
+            samples = self._cache.get(imageKey)
+            if samples is None:
+                samples = np.empty(
+                    (ihdrData.height, ihdrData.width, SAMPLES_PER_PIXEL[ihdrData.colourType]),
+                    dtype=get_sample_dtype(ihdrData.bitDepth)
+                )
+                sampleRows = iter_sample_rows(reread_idat_data(f), ihdrData, verify=self._verify, inflateBackend=self._inflateBackend)
+                for (rowIdx, row) in enumerate(sampleRows):
+                    samples[rowIdx] = row
+                self._cache.put(imageKey, samples)
+
+        return (pngDatastream, samples)
+
+    # reads the chunks before the image data (IHDR, PLTE, tRNS, ...)
+    def _read_header(self):
+        pngDatastream = PngDatastream()
+        with self._open_source() as f:
+            read_png_header(f, pngDatastream, self._verify)
+        self._pngDatastream = pngDatastream
+
+    # returns (pngDatastream, samples of rows start...stop-1); reads up to IEND if stop is the height
+    def _read_rows(self, start, stop):
+        pngDatastream = PngDatastream()
+        with self._open_source() as f:
+            idatData = read_png_header(f, pngDatastream, self._verify)
+            ihdrData = pngDatastream.get_idhr_chunk().get_data()
+
+            samples = np.empty(
+                (stop - start, ihdrData.width, SAMPLES_PER_PIXEL[ihdrData.colourType]),
+                dtype=get_sample_dtype(ihdrData.bitDepth)
+            )
+            sampleRows = iter_sample_rows(idatData, ihdrData, verify=self._verify, inflateBackend=self._inflateBackend, start=start, stop=stop)
+            for (rowIdx, row) in enumerate(sampleRows):
+                samples[rowIdx] = row
+
+            # read the chunks after the image data (i.e. IEND)
+            if stop == ihdrData.height:
+                for idatChunkData in idatData:
+                    pass
+
+        return (pngDatastream, samples)
+
+# =================================================================================
+# Decoded Image Cache
+#
+# - decoded samples are stored on disk as .npy files, one per image, named after a
+#   SHA-256 of the IHDR data and the data of all IDAT chunks. The hash is taken on
+#   a first pass over the IDAT chunks, before anything is inflated; on a miss the
+#   file is read again from the start, so the IDAT data is never held in memory.
+# - the samples do not depend on PLTE / tRNS (palette images store indices), so
+#   images differing only in those share an entry.
+# - a hit is memory-mapped (np.load(mmap_mode='r')): nothing is inflated, and only
+#   the pages actually read are loaded.
+# - LRU: a hit touches the file's modification time; after a file is added, the
+#   oldest files are removed until the total size is at most maxBytes.
+# - files are written under a temporary name and renamed, so several processes
+#   can share one directory.
+# =================================================================================
+CACHE_SIZE = 1 << 30    # default max. total size of the cache files, in bytes
+CACHE_EXTENSION = ".npy"
+
+class CacheStats:
+
+    def __init__(self):
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0            # images added
+        self._evictions = 0         # images removed to stay within the size limit
+        pass
+
+    # --- accessors ---
+    def get_hits(self):
+        return self._hits
+
+    def get_misses(self):
+        return self._misses
+
+    def get_stores(self):
+        return self._stores
 
-# --- format header ---
-header = ""
+    def get_evictions(self):
+        return self._evictions
 
-# atomic elements
-imgType = "P3" # P3 = ppm
-width = pngDatastream.get_idhr_chunk().get_data()['width']
-height = pngDatastream.get_idhr_chunk().get_data()['height']
-maxPixelVal = (1 << (pngDatastream.get_idhr_chunk().get_data()['bitDepth'])) - 1 # 0...255 = (1...256) - 1 = (2**8)-1 = (1<<8)-1
+    # --- mutators ---
+    def add_hit(self):
+        self._hits += 1
+
+    def add_miss(self):
+        self._misses += 1
+
+    def add_store(self):
+        self._stores += 1
 
-# combine lines
-lineOne = imgType
-lineTwo = " ".join([str(width), str(height)]) 
-lineThree = str(maxPixelVal)
-header = "\n".join([lineOne, lineTwo, lineThree])
+    def add_eviction(self):
+        self._evictions += 1
 
-# print(header)
+    def merge(self, other):
+        self._hits += other.get_hits()
+        self._misses += other.get_misses()
+        self._stores += other.get_stores()
+        self._evictions += other.get_evictions()
 
-# --- format data (draft) ---
-data = ""
-dataList = []
-for i in range(0, len(bytesFilteredScanlines)):
-    # print("{0} {1}".format(i, rawImgData[i]))
-    if pngDatastream.get_idhr_chunk().get_data()['colourType'] == 6 or pngDatastream.get_idhr_chunk().get_data()['colourType'] == 4: # with alpha
-        if i % ((width*3)+1) != 0 and i % 4 != 0: # 
-            dataList.append(bytesFilteredScanlines[i])
-        # elif i % ((width*3)+1) != 0:
-        #     print(bytesFilteredScanlines[i])
-    else: # without alpha
-        if i % ((width*3)+1) != 0:
-            dataList.append(bytesFilteredScanlines[i])
+    def format(self):
+        return "{0} hits, {1} misses, {2} stored, {3} evicted".format(self._hits, self._misses, self._stores, self._evictions)
+
+class DecodedImageCache:
+
+    def __init__(self, cacheDir, maxBytes=CACHE_SIZE):
+        self._cacheDir = cacheDir
+        self._maxBytes = maxBytes
+        self._stats = CacheStats()
+        os.makedirs(cacheDir, exist_ok=True)
+        pass
 
-data = " ".join([str(data) for data in dataList])
+    # --- accessors ---
+    def get_cache_dir(self):
+        return self._cacheDir
+
+    def get_max_bytes(self):
+        return self._maxBytes
+
+    def get_stats(self):
+        return self._stats
+
+    # samples stored for imageKey (read-only memory map), or None
+    @timed_stage('cache')
+    def get(self, imageKey):
+        fileName = self._get_file_name(imageKey)
+        try:
+            samples = np.load(fileName, mmap_mode='r')
+            os.utime(fileName)
+        except FileNotFoundError:
+            self._stats.add_miss()
+            return None
+        except (ValueError, OSError):   # e.g. truncated; decode again
+            self._remove(fileName)
+            self._stats.add_miss()
+            return None
+
+        self._stats.add_hit()
+        return samples
+
+    def put(self, imageKey, samples):
+        for row in self.iter_store_rows(imageKey, samples.shape, samples.dtype, samples):
+            pass
+
+    # - passes rows (as from iter_sample_rows()) through, writing them into a new cache
+    #   file as they go; the file is added once all rows went through.
+    # - images larger than the whole cache are not stored.
+    @timed_stage('cache')
+    def iter_store_rows(self, imageKey, shape, dtype, rows):
+        if int(np.prod(shape)) * np.dtype(dtype).itemsize > self._maxBytes:
+            yield from rows
+            return
+
+        tempFileName = os.path.join(self._cacheDir, "{0}.{1}.tmp".format(imageKey, os.getpid()))
+        samples = np.lib.format.open_memmap(tempFileName, mode='w+', dtype=dtype, shape=shape)
+        try:
+            for (rowIdx, row) in enumerate(rows):
+                samples[rowIdx] = row
+                yield row
+            samples.flush()
+            del samples
+            os.replace(tempFileName, self._get_file_name(imageKey))
+            self._stats.add_store()
+            self._evict()
+        finally:
+            self._remove(tempFileName)
+
+    def format(self):
+        return "{0} ({1})".format(self._stats.format(), self._cacheDir)
+
+    def _get_file_name(self, imageKey):
+        return os.path.join(self._cacheDir, imageKey + CACHE_EXTENSION)
+
+    def _remove(self, fileName):
+        try:
+            os.remove(fileName)
+        except FileNotFoundError:
+            pass
+
+    # remove the least recently used files until the total size is at most maxBytes
+    def _evict(self):
+        entries = []
+        for fileName in glob.glob(os.path.join(self._cacheDir, "*" + CACHE_EXTENSION)):
+            try:
+                fileStat = os.stat(fileName)
+            except FileNotFoundError:   # removed by another process
+                continue
+            entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+
+        totalBytes = sum([size for (mtime, size, fileName) in entries])
+        for (mtime, size, fileName) in sorted(entries):
+            if totalBytes <= self._maxBytes:
+                break
+            self._remove(fileName)
+            self._stats.add_eviction()
+            totalBytes -= size
+
+# - cache key of an image: SHA-256 of the IHDR data and of the data of every IDAT chunk.
+# - reads all of idatData (as from read_png_header()) one chunk at a time; nothing is kept,
+#   so the IDAT data is read again from the file for decoding (see reread_idat_data()).
+@timed_stage('cache')
+def get_image_key(ihdrData, idatData):
+    sha = hashlib.sha256(IHDR_FORMAT.pack(*ihdrData))
+    for idatChunkData in idatData:
+        sha.update(idatChunkData)
+    return sha.hexdigest()
+
+# - the IDAT data of f (a seekable file object) from the start again, as read_png_header().
+# - the CRC-32 of the chunks is not checked again: they were checked on the first pass.
+def reread_idat_data(f):
+    f.seek(0)
+    return read_png_header(f, PngDatastream(), verify=False)
 
-# --- combine header and data; output image ---
-image = header + "\n" + data
+# =================================================================================
+# Probe
+#
+# - header-only scan: reads the signature and the 8-byte header of every chunk, and
+#   seeks over the data of every chunk that is not stored (IDAT, and ancillary
+#   chunks other than tRNS); the cost is a few small reads whatever the file size.
+# =================================================================================
+COLOUR_TYPE_NAMES = {0: 'greyscale', 2: 'RGB', 3: 'palette', 4: 'greyscale+alpha', 6: 'RGBA'}
+INTERLACE_METHOD_NAMES = {0: 'no interlace', 1: 'Adam7'}
+PROBE_CHUNK_TYPES = (b'IHDR', b'PLTE', b'tRNS', b'IEND')    # chunks whose data is read; IDAT is seeked over
+
+# returns (pngDatastream holding IHDR / PLTE / tRNS / IEND, [(chunkType, length) of every chunk])
+def probe(fileName):
+    pngDatastream = PngDatastream()
+    pngDatastream.set_signature(PNG_SIGNATURE)
+    chunkList = []
+
+    with open(fileName, "rb") as f:
+        for (chunkStartIdx, length, chunkType, chunkData, crc) in iter_file_chunk_fields(f, PROBE_CHUNK_TYPES):
+            chunkList.append((chunkType, length))
+            if chunkData is not None:
+                pngDatastream.set_chunk(create_chunk(length, chunkType, chunkData, crc))
+            if chunkType == b'IEND':
+                break
+
+    if pngDatastream.get_idhr_chunk() is None:
+        raise ValueError("Missing IHDR chunk")
+    return (pngDatastream, chunkList)
+
+# one-line summary of probe() results, followed by the list of chunks
+def format_probe(fileName, pngDatastream, chunkList):
+    ihdrData = pngDatastream.get_idhr_chunk().get_data()
+    idatLengths = [length for (chunkType, length) in chunkList if chunkType == b'IDAT']
+
+    summary = "{0}: {1}x{2}, bit depth {3}, colour type {4} ({5}), {6}, {7} IDAT chunk(s) / {8} bytes".format(
+        fileName, ihdrData.width, ihdrData.height, ihdrData.bitDepth,
+        ihdrData.colourType, COLOUR_TYPE_NAMES.get(ihdrData.colourType, '?'),
+        INTERLACE_METHOD_NAMES.get(ihdrData.interlaceMethod, '?'), len(idatLengths), sum(idatLengths)
+    )
+    if pngDatastream.get_plte_chunk() is not None:
+        summary += ", {0} palette entries".format(len(pngDatastream.get_plte_chunk().get_data()))
+
+    chunks = " ".join(["{0}({1})".format(format_chunk_type(chunkType), length) for (chunkType, length) in chunkList])
+    return "\n".join([summary, "    chunks: " + chunks])
 
-outFileName = ".".join([fileName, "ppm"])
+# =================================================================================
+# PNG Encoding
+#
+# - samples => PNG: serialize and filter (H), compress (H2), and put the chunks
+#   into a PngDatastream (H3), the same model the reader fills.
+# - 1/2/3/4 samples per pixel => colour type 0/4/2/6; with a palette, the samples
+#   are palette indices (colour type 3), and palette alpha values become tRNS.
+# - PPM/PGM input (read_ppm()) with a max value of 2^n - 1 is stored with bit
+#   depth n where the colour type allows it; any other max value is scaled to 8
+#   or 16 bits.
+# =================================================================================
+COLOUR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}     # samples per pixel => colourType (without palette)
+
+# - samples = ndarray, shape (height, width, samples per pixel) or (height, width).
+# - bitDepth = None: 16 for sample types wider than 1 byte, otherwise 8.
+# - palette = None, or ndarray, shape (N, 3) or (N, 4) (RGB or RGBA), N <= 256.
+# - interlace = Adam7; filterType = None (adaptive), a filter type for every row, or a
+#   sequence of filter types used in turn, row after row.
+# - workers = number of compression threads; idatSize = max. data length of an IDAT chunk.
+def encode_png(samples, bitDepth=None, palette=None, interlace=False, filterType=None, level=COMPRESS_LEVEL, idatSize=IDAT_CHUNK_SIZE, workers=None):
+    samples = np.asarray(samples)
+    samples = (samples[..., None]) if (samples.ndim == 2) else (samples)
+    if samples.ndim != 3 or samples.shape[0] == 0 or samples.shape[1] == 0:
+        raise ValueError(samples.shape)
+    (height, width, samplesPerPixel) = samples.shape
+
+    if palette is not None:
+        palette = np.asarray(palette, dtype=np.uint8)
+        if samplesPerPixel != 1 or palette.ndim != 2 or palette.shape[1] not in (3, 4) or not (1 <= len(palette) <= 256):
+            raise ValueError("{0} {1}".format(samples.shape, palette.shape))
+        colourType = 3
+    elif samplesPerPixel in COLOUR_TYPES:
+        colourType = COLOUR_TYPES[samplesPerPixel]
+    else:
+        raise ValueError(samples.shape)
+
+    if bitDepth is None:
+        bitDepth = (16) if (samples.dtype.itemsize > 1 and colourType != 3) else (8)
+    get_bits_per_pixel(colourType, bitDepth)    # checks colour type and bit depth
+
+    maxSampleVal = ((1 << bitDepth) - 1) if (palette is None) else (min(len(palette), 1 << bitDepth) - 1)
+    if samples.min() < 0 or samples.max() > maxSampleVal:
+        raise ValueError("Sample values out of range: {0}...{1}".format(samples.min(), samples.max()))
+
+    pngDatastream = PngDatastream()
+    pngDatastream.set_signature(PNG_SIGNATURE)
+    pngDatastream.set_chunk(build_chunk(b'IHDR', IhdrData(
+        width=width,
+        height=height,
+        bitDepth=bitDepth,
+        colourType=colourType,
+        compressionMethod=0,
+        filterMethod=0,
+        interlaceMethod=(1) if (interlace) else (0)
+    )))
+
+    if palette is not None:
+        pngDatastream.set_chunk(build_chunk(b'PLTE', palette[:, 0:3]))
+        if palette.shape[1] == 4:
+            alphas = palette[:, 3]
+            opaque = np.flatnonzero(alphas != 255)
+            if len(opaque) > 0:     # trailing opaque entries may be left out of tRNS
+                pngDatastream.set_chunk(build_chunk(b'tRNS', alphas[0 : opaque[-1]+1]))
+
+    filteredData = b"".join(iter_filtered_bands(samples, colourType, bitDepth, (1) if (interlace) else (0), filterType))
+    zlibData = memoryview(compress_parallel(filteredData, level, workers))
+    for startIdx in range(0, len(zlibData), idatSize):
+        pngDatastream.set_chunk(build_chunk(b'IDAT', zlibData[startIdx : startIdx+idatSize]))
+
+    pngDatastream.set_chunk(build_chunk(b'IEND', None))
+    return pngDatastream
+
+# PPM/PGM samples and max value => (samples, bitDepth) for encode_png()
+def get_ppm_samples(samples, maxPixelVal):
+    colourType = COLOUR_TYPES[samples.shape[-1]]
+    for bitDepth in BIT_DEPTHS[colourType]:
+        if maxPixelVal == (1 << bitDepth) - 1:
+            return (samples, bitDepth)
+
+    bitDepth = (8) if (maxPixelVal < 255) else (16)
+    scaled = (samples.astype(np.uint32) * ((1 << bitDepth) - 1) + maxPixelVal // 2) // maxPixelVal
+    return (scaled.astype(get_sample_dtype(bitDepth)), bitDepth)
+
+# - convert one PPM/PGM image into a PNG image; returns the output file name.
+def encode_file(inFileName, outDir=None, interlace=False, level=COMPRESS_LEVEL, idatSize=IDAT_CHUNK_SIZE, workers=None):
+    with open(inFileName, "rb") as f:
+        (samples, maxPixelVal) = read_ppm(f)
+    (samples, bitDepth) = get_ppm_samples(samples, maxPixelVal)
+
+    pngDatastream = encode_png(samples, bitDepth, interlace=interlace, level=level, idatSize=idatSize, workers=workers)
+    outFileName = get_output_file_name(inFileName, "png", outDir)
+    with open(outFileName, 'wb') as out:
+        write_png_datastream(out, pngDatastream)
+
+    idatChunks = pngDatastream.get_idat_chunk()
+    logger.info("IDHR Chunk Data:                     %s", pngDatastream.get_idhr_chunk().get_data())
+    logger.info("IDAT chunks:                         %d (%d bytes)", len(idatChunks), sum([chunk.get_length() for chunk in idatChunks]))
+
+    return outFileName
 
-with open(outFileName,'w') as f:
-    f.write(image)
+# =================================================================================
+# Batch Conversion
+#
+# - inputs are files, directories (every *.png file in it, or every file with one
+#   of extNames) or glob patterns ("**" matches sub-directories); files are spread
+#   across a process pool.
+# - with outDir, the directories of the inputs are kept below it (get_output_dirs()).
+# =================================================================================
+def find_png_files(paths, extNames=("png",)):
+    fileNames = []
+    for path in paths:
+        if os.path.isdir(path):
+            dirFileNames = []
+            for extName in extNames:
+                dirFileNames += glob.glob(os.path.join(path, "*." + extName.lower())) + glob.glob(os.path.join(path, "*." + extName.upper()))
+            fileNames.extend(sorted(dirFileNames))
+        elif os.path.isfile(path):
+            fileNames.append(path)
+        else:
+            fileNames.extend(sorted(glob.glob(path, recursive=True)))
+
+    # remove duplicates, keep order
+    return list(dict.fromkeys(fileNames))
+
+# - worker; returns (inFileName, outFileName, None, stats, cacheStats, instrumentation) or
+#   (inFileName, None, error message, stats, cacheStats, instrumentation).
+# - cacheDir = directory of the DecodedImageCache shared by all workers, or None.
+# - instrument = record an Instrumentation of the conversion (else instrumentation is None).
+def _convert_one(inFileName, outDir, plain, verify, inflateBackend, cacheDir, cacheSize, instrument=False, traceMemory=False):
+    stats = IntegrityStats()
+    cacheStats = CacheStats()
+    instrumentation = (Instrumentation(traceMemory)) if (instrument) else (None)
+    try:
+        with instrumented(instrumentation):
+            cache = (DecodedImageCache(cacheDir, cacheSize)) if (cacheDir is not None) else (None)
+            cacheStats = (cache.get_stats()) if (cache is not None) else (cacheStats)
+            outFileName = convert(inFileName, outDir, plain, verify, stats, inflateBackend, cache)
+        return (inFileName, outFileName, None, stats, cacheStats, instrumentation)
+    except Exception as e:
+        return (inFileName, None, "{0}: {1}".format(type(e).__name__, e), stats, cacheStats, instrumentation)
+
+# worker; as _convert_one(), PPM/PGM => PNG (stats stays empty)
+def _encode_one(inFileName, outDir, interlace, level, idatSize, instrument=False, traceMemory=False):
+    stats = IntegrityStats()
+    instrumentation = (Instrumentation(traceMemory)) if (instrument) else (None)
+    try:
+        with instrumented(instrumentation):
+            outFileName = encode_file(inFileName, outDir, interlace, level, idatSize)
+        return (inFileName, outFileName, None, stats, CacheStats(), instrumentation)
+    except Exception as e:
+        return (inFileName, None, "{0}: {1}".format(type(e).__name__, e), stats, CacheStats(), instrumentation)
+
+# returns the results of _convert_one(), in the order of inFileNames
+def convert_batch(inFileNames, outDir=None, plain=False, workers=None, verify=True, inflateBackend='zlib', cacheDir=None, cacheSize=CACHE_SIZE, instrument=False, traceMemory=False):
+    return _run_batch(_convert_one, inFileNames, outDir, workers, (plain, verify, inflateBackend, cacheDir, cacheSize, instrument, traceMemory))
+
+# returns the results of _encode_one(), in the order of inFileNames
+def encode_batch(inFileNames, outDir=None, workers=None, interlace=False, level=COMPRESS_LEVEL, idatSize=IDAT_CHUNK_SIZE, instrument=False, traceMemory=False):
+    return _run_batch(_encode_one, inFileNames, outDir, workers, (interlace, level, idatSize, instrument, traceMemory))
+
+# - output directory of every input file; below outDir, the directories of the inputs
+#   are kept relative to their common root, so that e.g. a/x.png and b/x.png do not
+#   write the same file.
+# - outDir = None => None for every file (next to each input).
+def get_output_dirs(inFileNames, outDir=None):
+    if outDir is None or len(inFileNames) == 0:
+        return [outDir] * len(inFileNames)
+
+    inDirNames = [os.path.dirname(os.path.abspath(inFileName)) for inFileName in inFileNames]
+    try:
+        rootDirName = os.path.commonpath(inDirNames)
+    except ValueError:  # e.g. inputs on different drives
+        return [outDir] * len(inFileNames)
+    return [os.path.normpath(os.path.join(outDir, os.path.relpath(inDirName, rootDirName))) for inDirName in inDirNames]
+
+# - output file name of inFileName, without the extension (which may depend on the
+#   image, e.g. .ppm or .pgm); equal keys => the outputs may be the same file.
+def get_output_file_key(inFileName, outDir=None):
+    (fileName, extName) = os.path.splitext(get_output_file_name(inFileName, "", outDir))
+    return os.path.normcase(os.path.abspath(fileName))
+
+# - worker(inFileName, outDir, *workerArgs) for every file.
+# - an input whose output would clash with the one of an earlier input is not
+#   converted; it is reported as a failure instead.
+def _run_batch(worker, inFileNames, outDir, workers, workerArgs):
+    results = [None] * len(inFileNames)
+    jobs = []
+    firstInFileNames = {}
+    for (idx, (inFileName, fileOutDir)) in enumerate(zip(inFileNames, get_output_dirs(inFileNames, outDir))):
+        outFileKey = get_output_file_key(inFileName, fileOutDir)
+        if outFileKey in firstInFileNames:
+            error = "Output file name clashes with the one of {0}".format(firstInFileNames[outFileKey])
+            results[idx] = (inFileName, None, error, IntegrityStats(), CacheStats(), None)
+            continue
+
+        firstInFileNames[outFileKey] = inFileName
+        if fileOutDir is not None:
+            os.makedirs(fileOutDir, exist_ok=True)
+        jobs.append((idx, inFileName, fileOutDir))
+
+    workers = (os.cpu_count() or 1) if (workers is None) else (workers)
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1:
+        for (idx, inFileName, fileOutDir) in jobs:
+            results[idx] = worker(inFileName, fileOutDir, *workerArgs)
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(idx, executor.submit(worker, inFileName, fileOutDir, *workerArgs)) for (idx, inFileName, fileOutDir) in jobs]
+        for (idx, future) in futures:
+            results[idx] = future.result()
+    return results
+
+# - profile of a batch (as from convert_batch(..., instrument=True)) as JSON:
+#   {"files": {inFileName: Instrumentation.to_dict(), ...}, "total": ...}.
+# - fileName = "-" => stdout.
+def write_profile(fileName, results, totalInstrumentation):
+    profile = {
+        'files': {result[0]: result[5].to_dict() for result in results if result[5] is not None},
+        'total': totalInstrumentation.to_dict()
+    }
+    if fileName == "-":
+        json.dump(profile, sys.stdout, indent=1)
+        print()
+    else:
+        with open(fileName, 'w') as out:
+            json.dump(profile, out, indent=1)
 
-print("[*] Program ends...")
\ No newline at end of file
+# =================================================================================
+# Main
+# =================================================================================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert PNG images into PPM/PGM images, or PPM/PGM images into PNG images (--to-png).")
+    parser.add_argument("paths", nargs='+', help="PNG (PPM/PGM with --to-png) files, directories or glob patterns")
+    parser.add_argument("--info", action='store_true', help="only print the header information of each image (no conversion)")
+    parser.add_argument("--plain", action='store_true', help="write plain-text P3/P2 instead of binary P6/P5")
+    parser.add_argument("-o", "--output-dir", default=None, help="output directory, keeps the sub-directories of the inputs (default: next to each input)")
+    parser.add_argument("--no-verify", dest='verify', action='store_false', help="skip the CRC-32 / ADLER-32 checks")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--inflate", choices=INFLATE_BACKENDS, default='zlib', help="DEFLATE decoder: zlib (default) or native (pure Python)")
+    parser.add_argument("--cache", default=None, metavar="DIR", help="keep decoded images in this directory, and reuse them for the same image data")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE >> 20, metavar="MB", help="max. size of the cache directory (default: {0} MB)".format(CACHE_SIZE >> 20))
+    parser.add_argument("-v", "--verbose", action='count', default=0, help="log the steps and details of each image (-vv: and every chunk)")
+    parser.add_argument("--profile", default=None, metavar="JSON", help="write the time, bytes and calls of every stage into this file (- = stdout, with the summary on stderr)")
+    parser.add_argument("--trace-memory", action='store_true', help="with --profile: also track the peak memory of every stage (slow)")
+    parser.add_argument("--to-png", action='store_true', help="encode PPM/PGM images into PNG images")
+    parser.add_argument("--interlace", action='store_true', help="with --to-png: write Adam7 interlaced images")
+    parser.add_argument("--level", type=int, default=COMPRESS_LEVEL, choices=range(0, 10), metavar="0-9", help="with --to-png: zlib compression level (default: {0})".format(COMPRESS_LEVEL))
+    parser.add_argument("--idat-size", type=int, default=IDAT_CHUNK_SIZE, help="with --to-png: max. bytes of data per IDAT chunk (default: {0})".format(IDAT_CHUNK_SIZE))
+    args = parser.parse_args(argv)
+
+    if args.idat_size <= 0:
+        parser.error("--idat-size must be positive")
+    if args.verbose > 0:    # before the workers start, so that they inherit it
+        logging.basicConfig(format="[*] %(message)s", level=(logging.INFO) if (args.verbose == 1) else (logging.DEBUG))
+    inFileNames = find_png_files(args.paths, ("ppm", "pgm") if (args.to_png) else ("png",))
+    if len(inFileNames) == 0:
+        parser.error("no {0} files found".format("PPM/PGM" if args.to_png else "PNG"))
+
+    if args.info:
+        failures = 0
+        for inFileName in inFileNames:
+            try:
+                print(format_probe(inFileName, *probe(inFileName)))
+            except Exception as e:
+                print("[-] {0}: {1}: {2}".format(inFileName, type(e).__name__, e))
+                failures += 1
+        return (1) if (failures > 0) else (0)
+
+    instrument = args.profile is not None
+    if args.to_png:
+        results = encode_batch(inFileNames, args.output_dir, args.workers, args.interlace, args.level, args.idat_size, instrument, args.trace_memory)
+    else:
+        results = convert_batch(inFileNames, args.output_dir, args.plain, args.workers, args.verify, args.inflate, args.cache, args.cache_size << 20, instrument, args.trace_memory)
+
+    report = (sys.stderr) if (args.profile == "-") else (sys.stdout)    # stdout only holds the JSON profile then
+    print("\n[*] Summary", file=report)
+    failures = 0
+    totalStats = IntegrityStats()
+    totalCacheStats = CacheStats()
+    totalInstrumentation = Instrumentation(args.trace_memory)
+    for (inFileName, outFileName, error, stats, cacheStats, instrumentation) in results:
+        totalStats.merge(stats)
+        totalCacheStats.merge(cacheStats)
+        if instrumentation is not None:
+            totalInstrumentation.merge(instrumentation)
+        if error is None:
+            print("[+] {0} -> {1}".format(inFileName, outFileName), file=report)
+        else:
+            print("[-] {0}: {1}".format(inFileName, error), file=report)
+            failures += 1
+    print("[*] {0} converted, {1} failed".format(len(results) - failures, failures), file=report)
+    if args.verify and not args.to_png:
+        print("[*] verification: {0}".format(totalStats.format()), file=report)
+    if args.cache is not None and not args.to_png:
+        print("[*] cache: {0}".format(totalCacheStats.format()), file=report)
+    if instrument:
+        print("[*] profile: {0}".format(totalInstrumentation.format()), file=report)
+        write_profile(args.profile, results, totalInstrumentation)
+
+    return (1) if (failures > 0) else (0)
+
+if __name__ == "__main__":
+    sys.exit(main())